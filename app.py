@@ -1,7 +1,14 @@
-from flask import Flask, jsonify, render_template, send_from_directory, request, redirect, url_for, flash, abort
-import os, uuid, dropbox, time, logging
+from flask import Flask, jsonify, render_template, send_from_directory, request, redirect, url_for, flash, abort, Response, Request, stream_with_context, g, before_render_template, template_rendered
+import os, re, sys, uuid, dropbox, time, logging, heapq, hashlib, json, sqlite3, threading
 from werkzeug.utils import secure_filename
-from threading import Lock
+from werkzeug.datastructures import FileStorage
+from werkzeug.security import safe_join
+from werkzeug.exceptions import RequestEntityTooLarge, NotFound
+from urllib.parse import quote
+from threading import Lock, Thread, Condition
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from storage import CACHE_SCHEMA, DropboxStorage, LocalFSStorage, LRUCache
 
 # Optional .env
 try:
@@ -10,74 +17,1114 @@ try:
 except ImportError:
     pass
 
+# Optional fcntl (POSIX): cross-process sync lock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Optional gevent: under a gevent worker, threading is monkey-patched, so CPU-bound
+# pools need gevent's native-thread executor or decoding would stall every greenlet
+try:
+    from gevent import monkey as gevent_monkey
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    gevent_monkey = None
+
+# Optional Pillow (renditions)
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+def _gevent_patched():
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('threading')
+
+def cpu_pool(max_workers, name):
+    """Executor for CPU-bound work (Pillow decoding): OS threads under any worker class."""
+    if _gevent_patched():
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY","change-me")
 
 BASE_DIR = os.path.dirname(__file__)
-IMAGE_FOLDER = os.path.join(BASE_DIR, 'images')
+IMAGE_FOLDER = os.environ.get("IMAGE_FOLDER") or os.path.join(BASE_DIR, 'images')
 MEDIA_FOLDER = os.path.join(BASE_DIR, 'media')
+RENDITION_FOLDER = os.environ.get("RENDITION_FOLDER") or os.path.join(BASE_DIR, 'renditions')
+STATE_FOLDER = os.environ.get("STATE_FOLDER") or os.path.join(BASE_DIR, 'state')  # shared by all workers
+CHUNKED_FOLDER = os.path.join(STATE_FOLDER, 'uploads')  # resumable upload sessions (metadata)
 os.makedirs(IMAGE_FOLDER, exist_ok=True)
 os.makedirs(MEDIA_FOLDER, exist_ok=True)
+os.makedirs(STATE_FOLDER, exist_ok=True)
+os.makedirs(CHUNKED_FOLDER, exist_ok=True)
+
+# IMAGES is always the local IMAGE_FOLDER. Listing, stats, writes and deletes of
+# originals go through it; serving, renditions, metadata and tiered fetches open its
+# local paths directly.
+IMAGES = LocalFSStorage(IMAGE_FOLDER)
 
 # Extensions
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
 UPLOAD_EXTENSIONS = {'jpg','jpeg','png','gif','webp'}
 
 # Caching
-_IMAGE_CACHE = {"items":[], "last_scan":0.0, "fingerprint":0.0}
+# The image index lives in the `images` table of INDEX_DB, shared by all workers. Every
+# change bumps a generation counter; each process keeps an mtime-ordered copy and pulls
+# only the rows changed since the generation it last saw. IMAGE_FOLDER is re-listed
+# only when its mtime moves, by whichever worker notices first; the re-list stats every
+# name, so a file replaced under a known name (mv, rsync) gets a new version too.
+# The generation is also the clients' delta cursor: every item carries the generation
+# it was indexed at, which follows commit order across workers (mtimes don't).
+_IMAGE_CACHE = {"items":[], "names":{}, "last_scan":0.0, "fingerprint":0.0, "dir_mtime":None, "removed_at":0.0,
+                "gen":-1, "removed_gen":0}
 _CACHE_LOCK = Lock()
 SCAN_MIN_INTERVAL = 1.0
+DIR_MTIME_SETTLE_NS = 2_000_000_000  # coarse filesystems: keep re-checking a just-modified dir
+
+# Upload ingestion: request bodies are streamed straight into IMAGE_FOLDER
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 40*1024*1024))  # per file
+MAX_UPLOAD_PIXELS = 120_000_000  # reject decompression bombs before anything decodes them
+SNIFF_BYTES = 128*1024  # header bytes kept for magic/dimension checks (JPEG EXIF can be ~64 KB)
+UPLOAD_CONCURRENCY = max(1, int(os.environ.get("UPLOAD_CONCURRENCY", 4)))  # files finalized in parallel per batch
+_INGEST_LOCK = Lock()
+KIND_EXTENSIONS = {'jpeg':{'.jpg','.jpeg'}, 'png':{'.png'}, 'gif':{'.gif'}, 'webp':{'.webp'}}  # sniffed type -> names
+_VERIFY_POOL = cpu_pool(UPLOAD_CONCURRENCY, "verify")  # decode checks of uploads
+CHUNK_MAX_BYTES = 8*1024*1024
+CHUNKED_UPLOAD_TTL = 24*3600
+
+# Content-hash index (SQLite, shared by all workers): duplicate detection by content
+INDEX_DB = os.path.join(STATE_FOLDER, 'index.db')
+HASH_CHUNK_BYTES = 1024*1024
+DROPBOX_HASH_BLOCK = 4*1024*1024  # Dropbox content_hash block size
+# One connection per OS thread. Under gevent, threading.local is per greenlet and every
+# request gets a new greenlet, so use the unpatched one: the hub's greenlets share a
+# connection. sqlite3 calls never yield, and no transaction here spans cooperative I/O.
+if _gevent_patched():
+    _DB_LOCAL = gevent_monkey.get_original('threading', 'local')()
+else:
+    _DB_LOCAL = threading.local()
+_DB_INIT = {"pid":None}
+_DB_INIT_LOCK = Lock()
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (hash TEXT PRIMARY KEY, filename TEXT NOT NULL, size INTEGER, dbx_hash TEXT);
+CREATE INDEX IF NOT EXISTS hashes_filename ON hashes(filename);
+CREATE INDEX IF NOT EXISTS hashes_dbx ON hashes(dbx_hash);
+CREATE TABLE IF NOT EXISTS images (filename TEXT PRIMARY KEY, mtime REAL, mtime_ns INTEGER, size INTEGER,
+                                   gen INTEGER, deleted INTEGER DEFAULT 0);
+CREATE INDEX IF NOT EXISTS images_gen ON images(gen);
+CREATE TABLE IF NOT EXISTS index_state (id INTEGER PRIMARY KEY CHECK (id=1), gen INTEGER, dir_mtime INTEGER, removed_at REAL,
+                                        removed_gen INTEGER DEFAULT 0);
+INSERT OR IGNORE INTO index_state (id, gen, dir_mtime, removed_at) VALUES (1, 0, NULL, 0);
+CREATE TABLE IF NOT EXISTS meta (filename TEXT PRIMARY KEY, mtime REAL, width INTEGER, height INTEGER,
+                                 orientation INTEGER, taken REAL, color TEXT);
+""" + CACHE_SCHEMA
+
+# Image metadata, extracted once per file version by a background worker into INDEX_DB.
+# width/height are as displayed, i.e. after applying the EXIF orientation.
+_META_POOL = cpu_pool(1, "meta")
+_META_JOBS = set()
+_META_LOCK = Lock()
+_META_CACHE = {}  # filename -> (mtime, meta)
+META_FIELDS = ("width", "height", "orientation", "taken", "color")
+EXIF_ORIENTATION, EXIF_DATETIME, EXIF_DATETIME_ORIGINAL, EXIF_IFD = 0x0112, 0x0132, 0x9003, 0x8769
+
+# Renditions: downscaled WebP copies served to the slideshow screens instead of originals
+RENDITION_SIZES = {"thumb":320, "medium":960, "full":1920}  # max width in px
+RENDITION_QUALITY = int(os.environ.get("RENDITION_QUALITY", 80))
+_RENDITION_POOL = cpu_pool(int(os.environ.get("RENDITION_WORKERS", 2)), "rendition")
+_RENDITION_JOBS = {}
+_RENDITION_LOCK = Lock()
+
+# Dropbox client cache: one client (and HTTP session) per process
+DROPBOX_ACCOUNT_TTL = 300
+DROPBOX_RETRY_SECONDS = 60
+_DROPBOX = {"client":None, "account":None, "account_at":0.0, "failed_at":0.0}
+_DROPBOX_LOCK = Lock()
+
+# Live events: an append-only file every gunicorn worker tails, so a publish in
+# one worker reaches the /events streams held open by all of them
+EVENT_LOG = os.path.join(STATE_FOLDER, 'events.log')
+EVENT_LOG_MAX_BYTES = 256*1024
+EVENT_POLL_INTERVAL = 1.0
+EVENT_HEARTBEAT_SECONDS = 15
+EVENT_STREAM_SECONDS = int(os.environ.get("EVENT_STREAM_SECONDS", 300))  # clients reconnect after this
+
+# Image delivery
+IMAGE_CACHE_SECONDS = 365*24*3600  # for versioned (?v=) URLs, which never change content
+IMAGE_REVALIDATE_SECONDS = 300  # unversioned URLs: short cache, then a conditional GET
+IMAGE_ACCEL_PREFIX = os.environ.get("IMAGE_ACCEL_PREFIX","").rstrip('/')  # nginx internal location, e.g. /_protected
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE","").lower() in ("1","true","yes")  # Apache/lighttpd
+
+# Metrics: Prometheus text on /metrics. Each worker keeps its own counters and
+# snapshots them to METRICS_FOLDER; a scrape of any worker sums the live ones.
+METRICS_FOLDER = os.path.join(STATE_FOLDER, 'metrics')
+METRICS_FLUSH_SECONDS = 5
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 120)
+_METRICS = {"counters":{}, "histograms":{}, "flushed_at":0.0}
+_METRICS_LOCK = Lock()
+# Sampling profiler, opt-in: PROFILE_SAMPLE_SECONDS=0.01 samples every thread's stack
+# that often; /debug/profile returns the collapsed stacks (flamegraph.pl / speedscope).
+# Under gevent it samples OS threads: the hub (whichever greenlet is on the CPU, shown
+# as "gevent-hub") and the native cpu_pool threads; greenlets waiting on I/O don't appear.
+PROFILE_SAMPLE_SECONDS = float(os.environ.get("PROFILE_SAMPLE_SECONDS", 0) or 0)
+PROFILE_MAX_STACKS = 20000
+_PROFILE = {"stacks":{}, "samples":0, "started":None}
+_PROFILE_LOCK = gevent_monkey.get_original('threading', 'Lock')() if _gevent_patched() else Lock()  # taken by the sampler's OS thread
+os.makedirs(METRICS_FOLDER, exist_ok=True)
+
+# Landing page: only the first carousel page is rendered server-side, the rest is paged in
+SSR_PAGE_SIZE = 24
+_SSR_CACHE = {"key":None, "html":None}  # rendered index.html for one index state
+
+# Playback manifest: what the slideshow preloads next
+MANIFEST_DEFAULT_COUNT = 24
+MANIFEST_MAX_COUNT = 200
+_DIMENSIONS = {}  # filename -> (mtime, width, height), from a header sniff
 
 # Sync state
-LAST_SYNC_TIME = None
-SYNC_COOLDOWN_SECONDS = 300  # 5 minutes
+SYNC_COOLDOWN_SECONDS = 300  # 5 minutes between manual syncs
+SYNC_LOCK_FILE = os.path.join(STATE_FOLDER, 'sync.lock')  # flock'ed while a sync runs (any worker)
+SYNC_RECORD_FILE = os.path.join(STATE_FOLDER, 'last_sync.json')  # last run, shared by all workers
+SYNC_LOCK_POLL = 0.5
+_SYNC_LOCAL_LOCK = Lock()  # stands in for the file lock where fcntl is unavailable (per process only)
+_SYNC_HELD = {"pid":None}  # this process holds the sync lock (a flock probe can't tell)
 DROPBOX_FOLDER = os.environ.get("DROPBOX_FOLDER","").strip()  # empty = root of app folder
+SYNC_CONCURRENCY = max(1, int(os.environ.get("SYNC_CONCURRENCY", 4)))  # parallel downloads
+SYNC_RETRIES = max(1, int(os.environ.get("SYNC_RETRIES", 3)))  # attempts per file
+SYNC_RETRY_BACKOFF = 0.5  # seconds, doubled per attempt
+SYNC_CHUNK_BYTES = 1024*1024
+SYNC_STATE_FILE = os.path.join(STATE_FOLDER, 'dropbox_sync.json')  # list_folder cursor + mirrored files
+DROPBOX_LONGPOLL = os.environ.get("DROPBOX_LONGPOLL","").lower() in ("1","true","yes")
+DROPBOX_LONGPOLL_TIMEOUT = 120  # seconds (Dropbox allows 30-480)
+SYNC_DEBOUNCE_SECONDS = float(os.environ.get("SYNC_DEBOUNCE_SECONDS", 5))  # quiet period before a queued sync runs
+SYNC_MAX_DELAY_SECONDS = 30  # ...but never postpone a queued sync longer than this
+SYNC_MANUAL_WAIT_SECONDS = 120  # /sync-dropbox-manual waits this long for its run
+
+# Sync job queue: triggers are coalesced into runs on one background worker thread
+_SYNC_JOB = {"state":"idle", "requested":0, "completed":0, "first_request":0.0, "last_request":0.0,
+             "rush":False, "reasons":set(), "last_started":None, "last_finished":None,
+             "last_ok":None, "last_message":None, "last_reasons":[], "runs":0}
+_SYNC_COND = Condition()
+_SYNC_WORKER = None
+
+# Tiered storage (opt-in): with STORAGE_CACHE_BYTES set, the blob store holds every
+# original and IMAGE_FOLDER is an LRU cache of them bounded by that many bytes.
+# Evicted originals are fetched back on demand; renditions are never evicted, so the
+# slideshow keeps running from RENDITION_FOLDER. The index is fed by uploads and syncs
+# instead of directory scans, since the cache folder no longer lists the library.
+STORAGE_CACHE_BYTES = int(os.environ.get("STORAGE_CACHE_BYTES", 0) or 0)
+TIERED = STORAGE_CACHE_BYTES > 0
+BLOB_BACKEND = os.environ.get("BLOB_BACKEND", "dropbox").lower()  # dropbox | local
+BLOB_DIR = os.environ.get("BLOB_DIR") or os.path.join(STATE_FOLDER, 'blobs')  # BLOB_BACKEND=local
+BLOB_FETCH_TIMEOUT = 60
+_BLOB_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="blob")  # network/disk I/O only
+_BLOB_FETCHES = {}
+_BLOB_LOCK = Lock()
+BLOBS = LocalFSStorage(BLOB_DIR) if BLOB_BACKEND=="local" else DropboxStorage(lambda: get_dropbox_client(), DROPBOX_FOLDER, SYNC_CHUNK_BYTES)
+CACHE = LRUCache(IMAGES, STORAGE_CACHE_BYTES, lambda: _db())
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s %(message)s')
 log = logging.getLogger("app")
 
-def _scan_images():
-    items = []
-    max_mtime = 0.0
-    if not os.path.isdir(IMAGE_FOLDER):
-        return [], 0.0
-    try:
-        with os.scandir(IMAGE_FOLDER) as it:
-            for e in it:
-                if not e.is_file(): continue
-                name_lower = e.name.lower()
-                if not any(name_lower.endswith(ext) for ext in ALLOWED_EXTENSIONS):
-                    continue
-                try:
-                    st = e.stat()
-                    mtime = st.st_mtime
-                    max_mtime = max(max_mtime, mtime)
-                    items.append({
-                        "filename": e.name,
-                        "url": f"/images/{e.name}",
-                        "path": e.path,
-                        "mtime": mtime
-                    })
-                except FileNotFoundError:
-                    continue
-        items.sort(key=lambda x: x["mtime"], reverse=True)
-        return items, max_mtime
+def _is_image_name(name):
+    name_lower=name.lower()
+    return any(name_lower.endswith(ext) for ext in ALLOWED_EXTENSIONS)
+
+def _image_item(name, mtime, mtime_ns, size, gen=0):
+    # ?v= changes whenever the file does, so image URLs can be cached as immutable
+    version=hashlib.blake2b(f"{mtime_ns}:{size}".encode(), digest_size=6).hexdigest()
+    return {
+        "filename": name,
+        "url": f"/images/{quote(name)}?v={version}",
+        "version": version,
+        "path": IMAGES.path(name),
+        "mtime": mtime,
+        "mtime_ns": mtime_ns,
+        "size": size,
+        "gen": gen
+    }
+
+def _index_apply(added, removed):
+    """Merge new items into / drop names from the local copy without a full re-sort.
+    The item list is replaced, never mutated, so callers can iterate it unlocked."""
+    c=_IMAGE_CACHE
+    if not added and not removed:
+        return
+    names=dict(c["names"])
+    items=c["items"]
+    # a known name with a new version was overwritten in place: re-slot it
+    replaced={i["filename"] for i in added if i["filename"] in names and names[i["filename"]]["url"]!=i["url"]}
+    if removed or replaced:
+        removed={n for n in set(removed)|replaced if n in names}
+        for n in removed: del names[n]
+        if removed:
+            items=[i for i in items if i["filename"] not in removed]
+    if added:
+        fresh={}
+        for item in added:
+            if item["filename"] in names:
+                continue
+            fresh[item["filename"]]=item
+        if fresh:
+            names.update(fresh)
+            new_items=sorted(fresh.values(), key=lambda x: x["mtime"], reverse=True)
+            items=list(heapq.merge(items, new_items, key=lambda x: x["mtime"], reverse=True))
+    c["items"]=items
+    c["names"]=names
+    c["fingerprint"]=items[0]["mtime"] if items else 0.0
+
+def _index_write(changed, removed, dir_mtime=None):
+    """Store changed rows (name, mtime, mtime_ns, size) and removed names under a new
+    generation, inside the caller's write transaction. Removing a name, or replacing a
+    live one with another version, moves removed_gen: a delta from an older cursor
+    can't express that an URL went away, so those clients reload the full list."""
+    conn=_db()
+    if dir_mtime is not None:
+        conn.execute("UPDATE index_state SET dir_mtime=?", (dir_mtime,))
+    if not changed and not removed:
+        return
+    conn.execute("UPDATE index_state SET gen=gen+1")
+    gen=conn.execute("SELECT gen FROM index_state").fetchone()[0]
+    replaced=conn.executemany("UPDATE images SET deleted=1 WHERE filename=? AND deleted=0 AND (mtime_ns!=? OR size!=?)",
+                              [(name, mtime_ns, size) for name, _, mtime_ns, size in changed]).rowcount if changed else 0
+    conn.executemany("INSERT OR REPLACE INTO images (filename, mtime, mtime_ns, size, gen, deleted) VALUES (?,?,?,?,?,0)",
+                     [(*row, gen) for row in changed])
+    if removed:
+        cur=conn.executemany("UPDATE images SET deleted=1, gen=? WHERE filename=? AND deleted=0", [(gen, n) for n in removed])
+        if cur.rowcount:
+            conn.execute("UPDATE index_state SET removed_at=?", (time.time(),))
+            replaced+=cur.rowcount
+    if replaced:
+        conn.execute("UPDATE index_state SET removed_gen=?", (gen,))
+
+def _index_note(filename, removed=False):
+    """Record a file written to / removed from IMAGE_FOLDER, for every worker."""
+    if not removed and not _is_image_name(filename):
+        return
+    st=None if removed else IMAGES.stat(filename)
+    if st is None:
+        removed=True
+    conn=_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if removed:
+            _index_write([], [filename])
+        else:
+            _index_write([(filename, st.mtime, st.mtime_ns, st.size)], [])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _index_scan(dir_mtime):
+    """Re-list IMAGES against the shared table; one worker per listing change."""
+    conn=_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT dir_mtime FROM index_state").fetchone()[0]==dir_mtime:
+            conn.execute("COMMIT")  # another worker already scanned this change
+            return
+        t=time.perf_counter()
+        known={r[0]: (r[1], r[2]) for r in conn.execute("SELECT filename, mtime_ns, size FROM images WHERE deleted=0")}
+        stats=IMAGES.stat_many(n for n in IMAGES.list() if _is_image_name(n))
+        # new names, and known ones replaced by another file (mtime or size moved)
+        changed=[(n, st.mtime, st.mtime_ns, st.size) for n, st in stats.items() if known.get(n)!=(st.mtime_ns, st.size)]
+        # A directory touched in the last tick may change again within the same mtime
+        # granularity; don't trust it until it has settled.
+        settled=time.time_ns()-dir_mtime>DIR_MTIME_SETTLE_NS
+        _index_write(changed, known.keys()-stats.keys(), dir_mtime if settled else 0)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    # Metrics take a lock, which can switch greenlets; under gevent the connection is
+    # shared by the hub's greenlets, so nothing may switch inside the transaction
+    metric_inc("image_index_scans_total")
+    metric_observe("image_index_scan_seconds", time.perf_counter()-t)
+
+def _index_refresh():
+    """Scan if the IMAGES listing changed (IMAGE_FOLDER's mtime moved) since this
+    process last looked."""
+    c=_IMAGE_CACHE
+    if TIERED:
+        return  # IMAGE_FOLDER is only a cache; uploads and syncs keep the index
+    dir_mtime=IMAGES.version()
+    if dir_mtime is None:
+        return
+    if dir_mtime==c["dir_mtime"]:
+        return
+    try:
+        _index_scan(dir_mtime)
     except Exception as ex:
         log.error(f"Scan error: {ex}")
-        return [], 0.0
+        return
+    settled=time.time_ns()-dir_mtime>DIR_MTIME_SETTLE_NS
+    c["dir_mtime"]=dir_mtime if settled else 0
+
+def _index_pull():
+    """Bring the local copy up to the shared generation (one indexed read when current)."""
+    c=_IMAGE_CACHE
+    conn=_db()
+    gen=conn.execute("SELECT gen FROM index_state").fetchone()[0]
+    if gen==c["gen"]:
+        metric_inc("image_index_lookups_total", result="hit")
+        return
+    metric_inc("image_index_lookups_total", result="pull" if c["gen"] >= 0 else "load")
+    conn.execute("BEGIN")  # one snapshot: the rows read are exactly those up to `gen`
+    try:
+        gen, removed_at, removed_gen = conn.execute("SELECT gen, removed_at, removed_gen FROM index_state").fetchone()
+        if c["gen"] < 0:
+            rows=conn.execute("SELECT filename, mtime, mtime_ns, size, deleted, gen FROM images WHERE deleted=0").fetchall()
+        else:
+            rows=conn.execute("SELECT filename, mtime, mtime_ns, size, deleted, gen FROM images WHERE gen>?", (c["gen"],)).fetchall()
+    finally:
+        conn.execute("COMMIT")
+    added, removed = [], set()
+    for name, mtime, mtime_ns, size, deleted, row_gen in rows:
+        if deleted:
+            removed.add(name)
+        else:
+            added.append(_image_item(name, mtime, mtime_ns, size, row_gen))
+    _index_apply(added, removed)
+    c["gen"], c["removed_at"], c["removed_gen"] = gen, removed_at, removed_gen
 
 def get_images(force=False):
     now = time.time()
     with _CACHE_LOCK:
-        if not force and (now - _IMAGE_CACHE["last_scan"] < SCAN_MIN_INTERVAL):
-            return _IMAGE_CACHE["items"]
-        items, fp = _scan_images()
-        if force or fp != _IMAGE_CACHE["fingerprint"]:
-            _IMAGE_CACHE["items"] = items
-            _IMAGE_CACHE["fingerprint"] = fp
-        _IMAGE_CACHE["last_scan"] = now
+        if force or now - _IMAGE_CACHE["last_scan"] >= SCAN_MIN_INTERVAL:
+            metric_inc("image_index_dir_checks_total")
+            _index_refresh()
+            _IMAGE_CACHE["last_scan"] = now
+        try:
+            _index_pull()
+        except sqlite3.Error as ex:
+            log.error(f"Index read error: {ex}")
         return _IMAGE_CACHE["items"]
 
+# Metrics
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def metric_inc(name, value=1, **labels):
+    key=(name, _labels(labels))
+    with _METRICS_LOCK:
+        _METRICS["counters"][key]=_METRICS["counters"].get(key, 0)+value
+
+def metric_observe(name, seconds, **labels):
+    key=(name, _labels(labels))
+    with _METRICS_LOCK:
+        h=_METRICS["histograms"].get(key)
+        if h is None:
+            h=_METRICS["histograms"][key]=[[0]*len(LATENCY_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                h[0][i]+=1
+        h[1]+=seconds
+        h[2]+=1
+
+@contextmanager
+def timed(name, **labels):
+    """Observe the duration of the block into histogram `name`."""
+    t=time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(name, time.perf_counter()-t, **labels)
+
+def _metrics_snapshot():
+    with _METRICS_LOCK:
+        return {"counters":[[n, l, v] for (n, l), v in _METRICS["counters"].items()],
+                "histograms":[[n, l, b[:], s, c] for (n, l), (b, s, c) in _METRICS["histograms"].items()]}
+
+def _metrics_flush(force=False):
+    """Write this worker's snapshot for the others to aggregate (rate limited)."""
+    now=time.time()
+    if not force and now-_METRICS["flushed_at"] < METRICS_FLUSH_SECONDS:
+        return
+    _METRICS["flushed_at"]=now
+    path=os.path.join(METRICS_FOLDER, f"{os.getpid()}.json")
+    tmp=f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp,'w') as f:
+            json.dump(_metrics_snapshot(), f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"Metrics flush failed: {e}")
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _label_value(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_text():
+    """Counters and histograms of every live worker in Prometheus text format."""
+    _metrics_flush(force=True)
+    counters, hists = {}, {}
+    for fn in os.listdir(METRICS_FOLDER):
+        if not fn.endswith('.json'):
+            continue
+        path=os.path.join(METRICS_FOLDER, fn)
+        if not _pid_alive(int(fn[:-5])):
+            try: os.remove(path)  # exited worker
+            except OSError: pass
+            continue
+        try:
+            with open(path) as f:
+                snap=json.load(f)
+        except (OSError, ValueError):
+            continue
+        for n, l, v in snap["counters"]:
+            key=(n, tuple(map(tuple, l)))
+            counters[key]=counters.get(key, 0)+v
+        for n, l, b, sm, c in snap["histograms"]:
+            key=(n, tuple(map(tuple, l)))
+            acc=hists.setdefault(key, [[0]*len(LATENCY_BUCKETS), 0.0, 0])
+            acc[0]=[x+y for x, y in zip(acc[0], b)]
+            acc[1]+=sm
+            acc[2]+=c
+    def fmt(labels, extra=()):
+        parts=[f'{k}="{_label_value(v)}"' for k, v in (*labels, *extra)]
+        return '{'+','.join(parts)+'}' if parts else ''
+    lines=[]
+    typed=set()
+    for (n, l), v in sorted(counters.items()):
+        if n not in typed:
+            lines.append(f"# TYPE {n} counter"); typed.add(n)
+        lines.append(f"{n}{fmt(l)} {v}")
+    for (n, l), (b, sm, c) in sorted(hists.items()):
+        if n not in typed:
+            lines.append(f"# TYPE {n} histogram"); typed.add(n)
+        for bound, count in zip(LATENCY_BUCKETS, b):
+            lines.append(f"{n}_bucket{fmt(l, (('le', bound),))} {count}")
+        lines.append(f"{n}_bucket{fmt(l, (('le', '+Inf'),))} {c}")
+        lines.append(f"{n}_sum{fmt(l)} {sm:.6f}")
+        lines.append(f"{n}_count{fmt(l)} {c}")
+    with _CACHE_LOCK:
+        count, gen = len(_IMAGE_CACHE["items"]), _IMAGE_CACHE["gen"]
+    lines+=["# TYPE images_indexed gauge", f"images_indexed {count}",
+            "# TYPE image_index_generation gauge", f"image_index_generation {gen}"]
+    return '\n'.join(lines)+'\n'
+
+def _profile_loop(sleep=time.sleep, get_ident=threading.get_ident, fixed_names=None):
+    """Collapsed-stack sampler: one count per thread stack per tick."""
+    me=get_ident()
+    names=fixed_names or {}
+    while True:
+        sleep(PROFILE_SAMPLE_SECONDS)
+        if fixed_names is None and len(names)!=threading.active_count():
+            names={t.ident: t.name for t in threading.enumerate()}
+        frames=sys._current_frames()
+        with _PROFILE_LOCK:
+            _PROFILE["samples"]+=1
+            stacks=_PROFILE["stacks"]
+            for ident, frame in frames.items():
+                if ident==me:
+                    continue
+                parts=[]
+                while frame is not None and len(parts) < 64:
+                    parts.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame=frame.f_back
+                parts.reverse()
+                key=';'.join([re.sub(r'[-_]?\d+$', '', names.get(ident, 'thread'))]+parts)
+                if key in stacks or len(stacks) < PROFILE_MAX_STACKS:
+                    stacks[key]=stacks.get(key, 0)+1
+
+# Content-hash index
+def _db_init():
+    """Put INDEX_DB in WAL mode and create the schema, once per process."""
+    with _DB_INIT_LOCK:
+        if _DB_INIT["pid"]==os.getpid():
+            return
+        conn=sqlite3.connect(INDEX_DB, timeout=10, isolation_level=None)
+        try:
+            for attempt in range(50):
+                # Several workers may open a new database at once. Switching it to WAL
+                # needs it unlocked, and the busy timeout doesn't apply to that.
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    break
+                except sqlite3.OperationalError:
+                    time.sleep(0.1)
+            conn.executescript(_DB_SCHEMA)
+            _db_migrate(conn)
+        finally:
+            conn.close()
+        _DB_INIT["pid"]=os.getpid()
+
+def _db_migrate(conn):
+    """Add index_state.removed_gen to a database created before it existed."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if "removed_gen" not in {r[1] for r in conn.execute("PRAGMA table_info(index_state)")}:
+            conn.execute("ALTER TABLE index_state ADD COLUMN removed_gen INTEGER DEFAULT 0")
+            conn.execute("UPDATE index_state SET removed_gen=(SELECT COALESCE(MAX(gen), 0) FROM images WHERE deleted=1)")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _db():
+    """Per-OS-thread (and per-process) connection to INDEX_DB in WAL mode."""
+    conn=getattr(_DB_LOCAL, 'conn', None)
+    if conn is None or _DB_LOCAL.pid!=os.getpid():
+        _db_init()
+        conn=sqlite3.connect(INDEX_DB, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        metric_inc("index_db_connections_total")
+        _DB_LOCAL.conn, _DB_LOCAL.pid = conn, os.getpid()
+    return conn
+
+class ContentHasher:
+    """Incremental BLAKE2b plus Dropbox's content_hash (SHA-256 over 4 MB block digests),
+    so a Dropbox listing can be matched against local files without downloading."""
+    def __init__(self):
+        self.blake=hashlib.blake2b(digest_size=20)
+        self.blocks=hashlib.sha256()
+        self.block=hashlib.sha256()
+        self.block_fill=0
+        self.size=0
+
+    def update(self, data):
+        self.blake.update(data)
+        self.size+=len(data)
+        view=memoryview(data)
+        while view:
+            take=min(len(view), DROPBOX_HASH_BLOCK-self.block_fill)
+            self.block.update(view[:take])
+            self.block_fill+=take
+            view=view[take:]
+            if self.block_fill==DROPBOX_HASH_BLOCK:
+                self.blocks.update(self.block.digest())
+                self.block, self.block_fill = hashlib.sha256(), 0
+
+    def hexdigest(self):
+        return self.blake.hexdigest()
+
+    def dropbox_hexdigest(self):
+        blocks=self.blocks.copy()
+        if self.block_fill:
+            blocks.update(self.block.digest())
+        return blocks.hexdigest()
+
+def hash_file(filename):
+    h=ContentHasher()
+    for chunk in IMAGES.read_chunks(filename, HASH_CHUNK_BYTES):
+        h.update(chunk)
+    return h
+
+def hash_record(filename, hasher):
+    _db().execute("INSERT OR IGNORE INTO hashes (hash, filename, size, dbx_hash) VALUES (?,?,?,?)",
+                  (hasher.hexdigest(), filename, hasher.size, hasher.dropbox_hexdigest()))
+
+def hash_forget(filename):
+    _db().execute("DELETE FROM hashes WHERE filename=?", (filename,))
+
+def _in_library(filename):
+    """Whether an original is in the library: in IMAGES, or evicted from it to the blob
+    store (tiered storage) and still indexed."""
+    if IMAGES.exists(filename):
+        return True
+    if not TIERED:
+        return False
+    get_images()
+    return filename in _IMAGE_CACHE["names"]
+
+def _hash_lookup(column, value):
+    row=_db().execute(f"SELECT filename FROM hashes WHERE {column}=?", (value,)).fetchone()
+    if row is None:
+        return None
+    if not _in_library(row[0]):
+        hash_forget(row[0])  # removed behind our back
+        return None
+    return row[0]
+
+def find_duplicate(hasher):
+    """Name of a stored file with identical content, or None."""
+    return _hash_lookup("hash", hasher.hexdigest())
+
+def find_dropbox_duplicate(content_hash):
+    """Name of a stored file matching a Dropbox entry's content_hash, or None."""
+    return _hash_lookup("dbx_hash", content_hash) if content_hash else None
+
+@contextmanager
+def claim_job(name):
+    """Run a once-per-deployment background job in a single worker: yields True in the
+    worker holding state/<name>.lock, False in the others (which should skip it)."""
+    if fcntl is None:
+        yield True
+        return
+    with open(os.path.join(STATE_FOLDER, f"{name}.lock"), 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _hash_backfill():
+    """Hash images that predate the index (or were copied in by hand), in one worker."""
+    with claim_job("hash-backfill") as mine:
+        if not mine:
+            return
+        known={r[0] for r in _db().execute("SELECT filename FROM hashes")}
+        todo=[i for i in get_images() if i["filename"] not in known]
+        for item in todo:
+            try:
+                hash_record(item["filename"], hash_file(item["filename"]))
+            except OSError:
+                continue
+        if todo:
+            log.info(f"Hash index: backfilled {len(todo)} files")
+
+# Tiered storage
+def _cache_evict(keep=()):
+    try:
+        evicted=CACHE.evict(keep)
+    except Exception as e:
+        log.warning(f"Cache eviction failed: {e}")
+        return
+    if evicted:
+        metric_inc("storage_cache_evictions_total", len(evicted))
+        log.info(f"Storage cache: evicted {len(evicted)} originals")
+
+def _blob_fetch(filename, item):
+    """Copy an evicted original back into IMAGES with its indexed mtime, so
+    renditions, metadata and ?v= URLs made from the first copy stay current."""
+    tmp=os.path.join(IMAGE_FOLDER, f".fetch-{uuid.uuid4().hex}.part")
+    try:
+        with timed("blob_fetch_seconds"):
+            found=BLOBS.fetch(filename, tmp)
+        metric_inc("blob_fetches_total", result="ok" if found else "missing")
+        if not found:
+            return False
+        os.utime(tmp, ns=(item["mtime_ns"], item["mtime_ns"]))
+        IMAGES.put(filename, tmp, move=True)
+    except Exception as e:
+        metric_inc("blob_fetches_total", result="error")
+        log.warning(f"Fetch failed {filename}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    CACHE.add(filename, item["size"], stored=True)
+    _cache_evict(keep=(filename,))  # it may be bigger than the room left; the caller is about to read it
+    return True
+
+def ensure_local(filename):
+    """Local path of an original, fetching it from the blob store if the cache
+    evicted it (one fetch per file at a time). None if there is no such image."""
+    path=IMAGES.path(filename)
+    if not path:
+        return None
+    if os.path.isfile(path):
+        return path
+    if not TIERED:
+        return None
+    get_images()
+    item=_IMAGE_CACHE["names"].get(filename)
+    if item is None:
+        return None
+    with _BLOB_LOCK:
+        fut=_BLOB_FETCHES.get(filename)
+        if fut is None:
+            fut=_BLOB_POOL.submit(_blob_fetch, filename, item)
+            _BLOB_FETCHES[filename]=fut
+            fut.add_done_callback(lambda _f: _BLOB_FETCHES.pop(filename, None))
+    try:
+        return path if fut.result(timeout=BLOB_FETCH_TIMEOUT) else None
+    except Exception as e:
+        log.warning(f"Fetch wait failed {filename}: {e}")
+        return None
+
+def _blob_push(filename):
+    """Copy a new original to the blob store; only then may the cache evict it. A file
+    is pushed once however many callers ask: the claim is shared by all workers."""
+    if not CACHE.claim_push(filename):
+        return
+    try:
+        with timed("blob_push_seconds"):
+            ent=BLOBS.put(filename, IMAGES.path(filename))
+    except FileNotFoundError:
+        CACHE.forget(filename)
+        return
+    except Exception as e:
+        metric_inc("blob_pushes_total", result="error")
+        log.warning(f"Push failed {filename}: {e}")  # stays unstored; retried on restart
+        CACHE.release_push(filename)
+        return
+    metric_inc("blob_pushes_total", result="ok")
+    if BLOBS.is_dropbox:
+        _sync_note_pushed(filename, ent)
+    CACHE.mark_stored(filename)
+    _cache_evict()
+
+def _source_mtime(filename):
+    """mtime of an original: the stored file's, or the index's once it has been evicted."""
+    st=IMAGES.stat(filename)
+    if st is not None:
+        return st.mtime
+    if not TIERED:
+        raise FileNotFoundError(filename)
+    get_images()
+    item=_IMAGE_CACHE["names"].get(filename)
+    if item is None:
+        raise FileNotFoundError(filename)
+    return item["mtime"]
+
+def _cache_backfill():
+    """Track originals already in IMAGE_FOLDER when tiering is switched on, push any
+    the blob store lacks, then trim the folder to STORAGE_CACHE_BYTES. One worker."""
+    with claim_job("cache-backfill") as mine:
+        if not mine:
+            return
+        known=CACHE.known()
+        mirrored={f["name"] for f in _load_sync_state().get("files", {}).values()} if BLOBS.is_dropbox else set()
+        untracked=[n for n in IMAGES.list() if _is_image_name(n) and n not in known]
+        for name, st in IMAGES.stat_many(untracked).items():
+            _index_note(name)
+            CACHE.add(name, st.size, stored=name in mirrored)
+        todo=CACHE.unstored()  # uploads being pushed by their own worker are claimed, not listed
+        for name in todo:
+            _blob_push(name)
+        if todo:
+            log.info(f"Storage cache: pushed {len(todo)} originals to the blob store")
+        _cache_evict()
+
+# Metadata
+def _exif_time(value):
+    try:
+        return time.mktime(time.strptime(str(value).strip('\x00 ')[:19], "%Y:%m:%d %H:%M:%S"))
+    except (ValueError, OverflowError):
+        return None
+
+def _extract_meta(path):
+    """Dimensions, orientation, capture time and dominant colour of one image. PIL only
+    decodes a draft-sized copy for the colour; without PIL the header sniff gives size."""
+    meta=dict.fromkeys(META_FIELDS)
+    if Image is None:
+        with open(path,'rb') as f:
+            sniffed=_sniff_image(f.read(SNIFF_BYTES))
+        if sniffed:
+            meta["width"], meta["height"] = sniffed[1], sniffed[2]
+        return meta
+    with Image.open(path) as img:
+        w, h = img.size
+        exif=img.getexif()
+        orientation=exif.get(EXIF_ORIENTATION) or 1
+        if orientation in (5, 6, 7, 8):
+            w, h = h, w
+        meta.update(width=w, height=h, orientation=orientation)
+        meta["taken"]=_exif_time(exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME) or "")
+        img.draft('RGB', (64, 64))
+        small=img.convert('RGB')
+        small.thumbnail((64, 64))
+        quant=small.quantize(colors=8)
+        count, index = max(quant.getcolors())
+        palette=quant.getpalette()
+        meta["color"]='#%02x%02x%02x' % tuple(palette[index*3:index*3+3])
+    return meta
+
+def _meta_record(filename):
+    st=IMAGES.stat(filename)
+    row=_db().execute("SELECT mtime FROM meta WHERE filename=?", (filename,)).fetchone()
+    if row and (st is None or row[0]==st.mtime):
+        return  # current (another worker got here first), or evicted after extraction
+    path=ensure_local(filename)
+    if not path:
+        return
+    try:
+        mtime=os.path.getmtime(path)
+        meta=_extract_meta(path)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log.warning(f"Metadata failed {filename}: {e}")
+        return
+    _db().execute("INSERT OR REPLACE INTO meta (filename, mtime, width, height, orientation, taken, color) VALUES (?,?,?,?,?,?,?)",
+                  (filename, mtime, *(meta[k] for k in META_FIELDS)))
+
+def queue_meta(filename):
+    """Extract and store metadata for `filename` on the metadata worker (once per pending file)."""
+    with _META_LOCK:
+        if filename in _META_JOBS:
+            return
+        _META_JOBS.add(filename)
+    def run():
+        with _META_LOCK:
+            _META_JOBS.discard(filename)
+        _meta_record(filename)
+    _META_POOL.submit(run)
+
+def meta_forget(filename):
+    _META_CACHE.pop(filename, None)
+    _db().execute("DELETE FROM meta WHERE filename=?", (filename,))
+
+def image_meta(items):
+    """filename -> metadata dict for indexed items whose stored record is current.
+    Records are cached per process; missing or stale ones are queued, so later calls fill in."""
+    want=[i for i in items if _META_CACHE.get(i["filename"], (None,))[0]!=i["mtime"]]
+    for k in range(0, len(want), 500):
+        names=[i["filename"] for i in want[k:k+500]]
+        cur=_db().execute(f"SELECT filename, mtime, {', '.join(META_FIELDS)} FROM meta WHERE filename IN ({','.join('?'*len(names))})", names)
+        for r in cur:
+            _META_CACHE[r[0]]=(r[1], dict(zip(META_FIELDS, r[2:])))
+    out={}
+    for i in items:
+        hit=_META_CACHE.get(i["filename"])
+        if hit and hit[0]==i["mtime"]:
+            out[i["filename"]]=hit[1]
+        else:
+            queue_meta(i["filename"])
+    return out
+
+def _meta_backfill():
+    """Extract metadata for images indexed before the meta table existed, in one worker."""
+    with claim_job("meta-backfill") as mine:
+        if mine:
+            image_meta(get_images())
+            _META_POOL.submit(lambda: None).result()  # hold the claim until the queue drains
+
+# Renditions
+def _rendition_path(size, filename):
+    return os.path.join(RENDITION_FOLDER, size, filename + '.webp')
+
+def rendition_forget(filename):
+    """Delete every rendition of an image removed from the library."""
+    for size in RENDITION_SIZES:
+        try:
+            os.remove(_rendition_path(size, filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning(f"Rendition remove failed {filename}: {e}")
+
+def _rendition_fresh(size, filename, src_mtime):
+    try:
+        return os.path.getmtime(_rendition_path(size, filename)) >= src_mtime
+    except OSError:
+        return False
+
+def _render_renditions(filename):
+    """Decode the original once and write every missing/stale size. False if not renderable."""
+    src=ensure_local(filename)
+    if not src:
+        return False
+    src_mtime=os.path.getmtime(src)
+    todo=[s for s in RENDITION_SIZES if not _rendition_fresh(s, filename, src_mtime)]
+    if not todo:
+        return True
+    try:
+        with Image.open(src) as img, timed("rendition_seconds"):
+            if getattr(img, "is_animated", False):
+                return False
+            widest=max(RENDITION_SIZES[s] for s in todo)
+            img.draft('RGB', (widest, widest))  # JPEG: decode at reduced scale when possible
+            img=ImageOps.exif_transpose(img)
+            img=img.convert('RGBA' if img.mode in ('RGBA','LA','P') else 'RGB')
+            for size in sorted(todo, key=lambda s: RENDITION_SIZES[s], reverse=True):
+                width=RENDITION_SIZES[size]
+                out=img
+                if img.width > width:
+                    out=img.resize((width, max(1, round(img.height*width/img.width))), Image.LANCZOS)
+                dest=_rendition_path(size, filename)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                tmp=f"{dest}.{uuid.uuid4().hex}.part"
+                out.save(tmp, 'WEBP', quality=RENDITION_QUALITY, method=4)
+                os.replace(tmp, dest)
+        return True
+    except Exception as e:
+        log.warning(f"Rendition failed {filename}: {e}")
+        return False
+
+def queue_renditions(filename):
+    """Schedule rendition generation on the worker pool; returns the pending future."""
+    if Image is None:
+        return None
+    with _RENDITION_LOCK:
+        fut=_RENDITION_JOBS.get(filename)
+        if fut is None:
+            fut=_RENDITION_POOL.submit(_render_renditions, filename)
+            _RENDITION_JOBS[filename]=fut
+            fut.add_done_callback(lambda _f: _RENDITION_JOBS.pop(filename, None))
+        return fut
+
+def get_rendition(size, filename, timeout=30):
+    """Path of an up-to-date rendition, generating it on demand; None = serve the original."""
+    if Image is None:
+        return None
+    if not safe_join(IMAGE_FOLDER, filename):
+        return None
+    try:
+        if _rendition_fresh(size, filename, _source_mtime(filename)):
+            return _rendition_path(size, filename)  # pinned: served even if the original was evicted
+    except OSError:
+        return None
+    fut=queue_renditions(filename)
+    try:
+        if fut and fut.result(timeout=timeout):
+            return _rendition_path(size, filename)
+    except Exception as e:
+        log.warning(f"Rendition wait failed {filename}: {e}")
+    return None
+
+def image_dimensions(item):
+    """(width, height) of an indexed image from its header, cached until the file changes."""
+    name=item["filename"]
+    hit=_DIMENSIONS.get(name)
+    if hit and hit[0]==item["mtime"]:
+        return hit[1], hit[2]
+    try:
+        with IMAGES.open(name) as f:
+            sniffed=_sniff_image(f.read(SNIFF_BYTES))
+    except OSError:
+        return None, None
+    w, h = (sniffed[1], sniffed[2]) if sniffed else (None, None)
+    _DIMENSIONS[name]=(item["mtime"], w, h)
+    return w, h
+
+def manifest_entry(item, meta=None):
+    """Rendition URLs, dimensions and byte sizes of one image; missing renditions are queued.
+    `meta` is its stored metadata, if extracted yet (otherwise the header is sniffed)."""
+    name=item["filename"]
+    meta=meta or {}
+    w, h = (meta["width"], meta["height"]) if meta.get("width") else image_dimensions(item)
+    renditions={}
+    pending=False
+    for size, width in RENDITION_SIZES.items():
+        rw, rh = w, h
+        if w and h and w > width:
+            rw, rh = width, max(1, round(h*width/w))
+        nbytes=None
+        if Image is not None and _rendition_fresh(size, name, item["mtime"]):
+            try:
+                nbytes=os.path.getsize(_rendition_path(size, name))
+            except OSError:
+                pass
+        pending = pending or nbytes is None
+        renditions[size]={"url": item["url"].replace('/images/', f'/images/{size}/', 1),
+                          "width": rw, "height": rh, "bytes": nbytes}
+    if pending:
+        queue_renditions(name)
+    return {"filename": name, "url": item["url"], "width": w, "height": h,
+            "bytes": item["size"], "mtime": item["mtime"], "taken": meta.get("taken"),
+            "color": meta.get("color"), "renditions": renditions}
+
+def images_since(since):
+    """Items indexed after the `since` cursor (an index generation), newest first, or
+    None when the client has to reload the full list: the cursor predates a removal,
+    or isn't a generation this index has reached (an old mtime cursor, a reset index)."""
+    items=get_images()
+    c=_IMAGE_CACHE
+    if since < c["removed_gen"] or since > c["gen"]:
+        return None
+    if since==c["gen"]:
+        return []
+    return [i for i in items if i["gen"] > since]
+
+def index_etag():
+    """Strong validator for responses derived from the index (call after get_images())."""
+    c=_IMAGE_CACHE
+    state=f'{c["gen"]}:{c["fingerprint"]!r}:{c["removed_at"]!r}:{len(c["items"])}'
+    return hashlib.blake2b(state.encode(), digest_size=12).hexdigest()
+
+def conditional_response(etag, build):
+    """304 when the client already holds `etag`, otherwise the response from build()."""
+    if request.if_none_match.contains_weak(etag):
+        resp=app.response_class(status=304)
+    else:
+        resp=build()
+    resp.set_etag(etag)
+    resp.cache_control.no_cache=True  # always revalidate; a 304 costs a few bytes
+    return resp
+
+def conditional_json(etag, build):
+    """conditional_response for a JSON payload, only built (and serialized) on a miss."""
+    return conditional_response(etag, lambda: jsonify(build()))
+
+# Live events
+def publish_event(kind, **data):
+    """Append an event for every /events subscriber (any worker)."""
+    ev={"id":f"{time.time():.6f}","type":kind}
+    ev.update(data)
+    line=(json.dumps(ev)+"\n").encode()
+    try:
+        fd=os.open(EVENT_LOG, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)  # single O_APPEND write: lines from concurrent workers don't interleave
+        finally:
+            os.close(fd)
+        if os.path.getsize(EVENT_LOG) > EVENT_LOG_MAX_BYTES:
+            _rotate_event_log()
+    except OSError as e:
+        log.warning(f"Event publish failed: {e}")
+
+def _rotate_event_log():
+    # Keep the newer half under a new inode; subscribers notice the inode change and re-read it
+    with open(EVENT_LOG, 'rb') as f:
+        f.seek(-EVENT_LOG_MAX_BYTES//2, os.SEEK_END)
+        tail=f.read()
+    tail=tail[tail.find(b"\n")+1:]
+    tmp=f"{EVENT_LOG}.{uuid.uuid4().hex}.part"
+    with open(tmp, 'wb') as f:
+        f.write(tail)
+    os.replace(tmp, EVENT_LOG)
+
+def _event_stream(last_id=None):
+    """Tail EVENT_LOG as SSE. With last_id (Last-Event-ID) missed events are replayed."""
+    yield "retry: 3000\n\n"
+    replay=last_id is not None
+    if not replay:
+        last_id=time.time()  # ids are timestamps: ignore anything older than this stream
+    try:
+        st=os.stat(EVENT_LOG)
+        ino, pos = st.st_ino, (0 if replay else st.st_size)
+    except FileNotFoundError:
+        ino, pos = None, 0
+    started=last_beat=time.time()
+    while time.time()-started < EVENT_STREAM_SECONDS:
+        try:
+            st=os.stat(EVENT_LOG)
+        except FileNotFoundError:
+            st=None
+        if st is not None:
+            if st.st_ino!=ino or st.st_size<pos:
+                # created or rotated since we last looked
+                ino, pos = st.st_ino, 0
+            if st.st_size>pos:
+                with open(EVENT_LOG, 'rb') as f:
+                    f.seek(pos)
+                    chunk=f.read()
+                end=chunk.rfind(b"\n")+1  # leave a partially written line for the next round
+                pos+=end
+                for raw in chunk[:end].splitlines():
+                    try:
+                        ev=json.loads(raw)
+                        ev_id=float(ev["id"])
+                    except (ValueError, KeyError):
+                        continue
+                    if ev_id<=last_id:
+                        continue
+                    last_id=ev_id
+                    yield f"id: {ev['id']}\nevent: {ev['type']}\ndata: {raw.decode()}\n\n"
+                    last_beat=time.time()
+        if time.time()-last_beat >= EVENT_HEARTBEAT_SECONDS:
+            yield ": ping\n\n"
+            last_beat=time.time()
+        time.sleep(EVENT_POLL_INTERVAL)
+
 def allowed_file(filename:str):
     return '.' in filename and filename.rsplit('.',1)[1].lower() in UPLOAD_EXTENSIONS
 
@@ -103,118 +1150,750 @@ def update_env_variable(key, value):
         log.warning(f"Env write failed: {e}")
         return False
 
-def get_dropbox_client():
-    try:
-        refresh_token=os.environ.get('DROPBOX_REFRESH_TOKEN')
-        app_key=os.environ.get('APPKEY')
-        app_secret=os.environ.get('APPSECRET')
-        access_token=os.environ.get('DROPBOX_ACCESS_TOKEN')
+class _CountingDropbox:
+    """Client proxy that counts and times files_*/users_* API calls for /metrics."""
+    def __init__(self, dbx):
+        self._dbx=dbx
 
-        # OAuth2 refresh token flow
-        if refresh_token and app_key and app_secret:
+    def __getattr__(self, name):
+        attr=getattr(self._dbx, name)
+        if not name.startswith(('files_','users_')) or not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            t=time.perf_counter()
             try:
-                dbx=dropbox.Dropbox(oauth2_refresh_token=refresh_token, app_key=app_key, app_secret=app_secret)
-                account=dbx.users_get_current_account()
-                if dbx._oauth2_access_token:
-                    update_env_variable('DROPBOX_ACCESS_TOKEN', dbx._oauth2_access_token)
-                log.info(f"Dropbox connected (refresh token) as {account.name.display_name}")
-                return dbx
+                res=attr(*args, **kwargs)
             except Exception as e:
-                log.warning(f"Refresh token auth failed: {e}")
+                metric_inc("dropbox_calls_total", method=name, result=type(e).__name__)
+                raise
+            finally:
+                metric_observe("dropbox_call_seconds", time.perf_counter()-t, method=name)
+            metric_inc("dropbox_calls_total", method=name, result="ok")
+            return res
+        return call
 
-        # Legacy token
-        if not access_token:
-            tok_file=os.path.join(BASE_DIR,'dropbox-token.txt')
-            if os.path.exists(tok_file):
-                with open(tok_file,'r') as f:
-                    access_token=f.read().strip()
+def _build_dropbox_client():
+    """Connect once and return (client, account). One users_get_current_account round
+    trip validates the credentials and seeds the account cache."""
+    refresh_token=os.environ.get('DROPBOX_REFRESH_TOKEN')
+    app_key=os.environ.get('APPKEY')
+    app_secret=os.environ.get('APPSECRET')
+    access_token=os.environ.get('DROPBOX_ACCESS_TOKEN')
+    session=dropbox.create_session(max_connections=SYNC_CONCURRENCY+2)  # shared by every call on this client
 
-        if not access_token:
-            return None
+    # OAuth2 refresh token flow: the SDK refreshes the access token itself when it expires
+    if refresh_token and app_key and app_secret:
+        try:
+            dbx=_CountingDropbox(dropbox.Dropbox(oauth2_refresh_token=refresh_token, app_key=app_key, app_secret=app_secret, session=session))
+            account=dbx.users_get_current_account()
+            log.info(f"Dropbox connected (refresh token) as {account.name.display_name}")
+            return dbx, account
+        except Exception as e:
+            log.warning(f"Refresh token auth failed: {e}")
 
-        dbx=dropbox.Dropbox(access_token)
-        dbx.users_get_current_account()
-        return dbx
-    except Exception as e:
-        log.error(f"Dropbox client error: {e}")
+    # Legacy token
+    if not access_token:
+        tok_file=os.path.join(BASE_DIR,'dropbox-token.txt')
+        if os.path.exists(tok_file):
+            with open(tok_file,'r') as f:
+                access_token=f.read().strip()
+
+    if not access_token:
+        return None, None
+
+    dbx=_CountingDropbox(dropbox.Dropbox(access_token, session=session))
+    return dbx, dbx.users_get_current_account()
+
+def get_dropbox_client():
+    """Process-wide cached client (None without working credentials). Failed
+    connects are retried at most every DROPBOX_RETRY_SECONDS."""
+    now=time.time()
+    with _DROPBOX_LOCK:
+        d=_DROPBOX
+        if d["client"] is None and now-d["failed_at"] >= DROPBOX_RETRY_SECONDS:
+            try:
+                d["client"], account = _build_dropbox_client()
+            except Exception as e:
+                log.error(f"Dropbox client error: {e}")
+                d["client"], account = None, None
+            if d["client"] is None:
+                d["failed_at"]=now
+            else:
+                d["account"], d["account_at"] = account, now
+        dbx=d["client"]
+    # persist the access token whenever the SDK has refreshed it
+    token=getattr(dbx, '_oauth2_access_token', None) if dbx else None
+    if token and os.environ.get('DROPBOX_REFRESH_TOKEN') and token!=os.environ.get('DROPBOX_ACCESS_TOKEN'):
+        update_env_variable('DROPBOX_ACCESS_TOKEN', token)
+    return dbx
+
+def reset_dropbox_client():
+    """Drop the cached client, e.g. after an AuthError, so the next call reconnects."""
+    with _DROPBOX_LOCK:
+        _DROPBOX.update(client=None, account=None, account_at=0.0, failed_at=0.0)
+
+def get_dropbox_account():
+    """Account info, cached for DROPBOX_ACCOUNT_TTL so status polling stays local."""
+    dbx=get_dropbox_client()
+    if not dbx:
         return None
+    with _DROPBOX_LOCK:
+        if _DROPBOX["account"] is not None and time.time()-_DROPBOX["account_at"] < DROPBOX_ACCOUNT_TTL:
+            return _DROPBOX["account"]
+    try:
+        account=dbx.users_get_current_account()
+    except dropbox.exceptions.AuthError as e:
+        log.warning(f"Account info auth error: {e}")
+        reset_dropbox_client()
+        return None
+    with _DROPBOX_LOCK:
+        _DROPBOX["account"], _DROPBOX["account_at"] = account, time.time()
+    return account
+
+def _load_sync_state():
+    try:
+        with open(SYNC_STATE_FILE,'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_sync_state(state):
+    tmp=f"{SYNC_STATE_FILE}.{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp,'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, SYNC_STATE_FILE)
+    except OSError as e:
+        log.warning(f"Sync state write failed: {e}")
+
+def _sync_list_path(target_folder):
+    folder=target_folder.strip().strip('/')
+    return f"/{folder}" if folder else ""
+
+def _sync_note_pushed(name, ent):
+    """Record an original the app pushed to Dropbox as mirrored, like a downloaded one,
+    so that deleting it in Dropbox removes it here too. Waits out a running sync, which
+    would otherwise save its own copy of the state over this one."""
+    list_path=_sync_list_path(DROPBOX_FOLDER)
+    with _sync_lock():
+        state=_load_sync_state()
+        if state.get("folder")!=list_path:
+            state={"folder":list_path, "files":{}}
+        state.setdefault("files", {})[ent.path_lower]={"name":name, "rev":ent.rev}
+        _save_sync_state(state)
+
+def _list_changes(dbx, list_path, state):
+    """Entries changed since the saved cursor, or the whole folder when there is no
+    usable cursor. Returns (entries, new_cursor, full_listing)."""
+    result=None
+    cursor=state.get("cursor") if state.get("folder")==list_path else None
+    if cursor:
+        try:
+            result=dbx.files_list_folder_continue(cursor)
+        except dropbox.exceptions.ApiError as e:
+            if not (hasattr(e.error,'is_reset') and e.error.is_reset()):
+                raise
+            log.info("Dropbox cursor reset, relisting folder")
+    full=result is None
+    if full:
+        result=dbx.files_list_folder(list_path)
+    entries=list(result.entries)
+    while result.has_more:
+        result=dbx.files_list_folder_continue(result.cursor)
+        entries.extend(result.entries)
+    return entries, result.cursor, full
+
+@contextmanager
+def _sync_lock():
+    """Hold the cluster-wide sync lock, waiting for a run in another worker to finish."""
+    with _SYNC_LOCAL_LOCK:
+        if fcntl is None:
+            yield
+            return
+        with open(SYNC_LOCK_FILE, 'a') as f:
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(SYNC_LOCK_POLL)
+            _SYNC_HELD["pid"]=os.getpid()
+            try:
+                yield
+            finally:
+                _SYNC_HELD["pid"]=None
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def sync_running_elsewhere():
+    """True while another process holds the sync lock."""
+    if fcntl is None or _SYNC_HELD["pid"]==os.getpid():
+        return False  # ours: a probe on a new file description would see it as taken
+    with open(SYNC_LOCK_FILE, 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return False
+
+def load_sync_record():
+    try:
+        with open(SYNC_RECORD_FILE,'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_sync_record(rec):
+    tmp=f"{SYNC_RECORD_FILE}.{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp,'w') as f:
+            json.dump(rec, f)
+        os.replace(tmp, SYNC_RECORD_FILE)
+    except OSError as e:
+        log.warning(f"Sync record write failed: {e}")
+
+def run_sync_exclusive(requested_at, reasons):
+    """Run one sync under the cluster-wide lock. If another worker started a run after
+    `requested_at`, that run already covers this request and its result is joined.
+    Returns (ok, message, joined)."""
+    with _sync_lock():
+        rec=load_sync_record()
+        joined=bool(rec.get("finished")) and rec.get("started", 0)>=requested_at
+        if joined:
+            ok, msg = rec["ok"], rec["message"]
+        else:
+            rec.update(started=time.time(), finished=None, pid=os.getpid(), reasons=reasons)
+            _save_sync_record(rec)
+            try:
+                with timed("dropbox_sync_seconds"):
+                    ok,msg=sync_dropbox_images(DROPBOX_FOLDER)
+            except Exception as e:
+                ok,msg=False,f"Sync error: {e}"
+            rec.update(finished=time.time(), ok=ok, message=msg)
+        metric_inc("dropbox_syncs_total", result="joined" if joined else "ok" if ok else "error")
+        if ok and "manual" in reasons:
+            rec["manual_ok_at"]=time.time()  # starts the manual-sync cooldown everywhere
+        _save_sync_record(rec)
+        return ok, msg, joined
 
 def sync_dropbox_images(target_folder: str = ""):
     """
     Download new images from Dropbox (App Folder scope).
     target_folder: subfolder path ('' = root)
+    The list_folder cursor is persisted so each sync only fetches what changed;
+    files deleted (or renamed away) in Dropbox are removed locally if we mirrored them.
     """
     try:
         dbx=get_dropbox_client()
         if not dbx:
             return False, "No Dropbox credentials"
 
-        folder = target_folder.strip()
-        if folder.startswith('/'):
-            folder = folder[1:]
-        list_path = f"/{folder}" if folder else ""
+        list_path=_sync_list_path(target_folder)
+        state=_load_sync_state()
+        if state.get("folder")!=list_path:
+            state={"folder":list_path, "files":{}}
+        mirrored=state.setdefault("files",{})  # path_lower -> {"name","rev"} downloaded from Dropbox
 
         try:
-            result=dbx.files_list_folder(list_path)
+            entries, cursor, full = _list_changes(dbx, list_path, state)
         except dropbox.exceptions.ApiError as e:
             return False, f"List error: {e}"
 
-        entries=result.entries
-        while result.has_more:
-            result=dbx.files_list_folder_continue(result.cursor)
-            entries.extend(result.entries)
-
-        existing=set(os.listdir(IMAGE_FOLDER))
-        new_count=0
+        removed=0
+        if full:
+            listed={e.path_lower for e in entries}
+            gone=[p for p in mirrored if p not in listed]
+        else:
+            gone=[e.path_lower for e in entries if isinstance(e, dropbox.files.DeletedMetadata) and e.path_lower in mirrored]
+        for p in gone:
+            name=mirrored.pop(p)["name"]
+            try:
+                if not IMAGES.delete(name) and not TIERED:
+                    continue  # (tiered: an evicted original is still in the library)
+            except OSError as e:
+                log.warning(f"Remove failed {name}: {e}")
+                continue
+            hash_forget(name)
+            meta_forget(name)
+            _index_note(name, removed=True)
+            rendition_forget(name)  # tiered: never evicted, but not kept past the image
+            if TIERED:
+                CACHE.forget(name)
+                if not BLOBS.is_dropbox:
+                    BLOBS.delete(name)
+            removed+=1
 
+        todo=[]
+        skipped=0
         for ent in entries:
-            # Only FileMetadata
-            if isinstance(ent, dropbox.files.FileMetadata):
-                name=ent.name
-                ext=os.path.splitext(name)[1].lower()
-                if ext in ALLOWED_EXTENSIONS and name not in existing:
-                    try:
-                        _,resp=dbx.files_download(ent.path_lower)
-                        local_path=os.path.join(IMAGE_FOLDER,name)
-                        with open(local_path,'wb') as f:
-                            f.write(resp.content)
-                        now=time.time()
-                        os.utime(local_path,(now,now))
+            if not isinstance(ent, dropbox.files.FileMetadata):
+                continue
+            if os.path.splitext(ent.name)[1].lower() not in ALLOWED_EXTENSIONS:
+                continue
+            known=mirrored.get(ent.path_lower)
+            if known:
+                if known["rev"]!=ent.rev:
+                    todo.append(ent)  # changed in Dropbox: replace our copy
+            elif IMAGES.exists(ent.name):
+                continue
+            elif find_dropbox_duplicate(ent.content_hash):
+                skipped+=1  # same photo already here under another name
+            else:
+                todo.append(ent)
+
+        new_count=0
+        failed=0
+        started=time.time()
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(SYNC_CONCURRENCY, len(todo)), thread_name_prefix="dropbox-dl") as pool:
+                futures={pool.submit(_download_file, dbx, ent): ent for ent in todo}
+                for fut in as_completed(futures):
+                    ent=futures[fut]
+                    hasher=fut.result()
+                    if hasher:
+                        if ent.path_lower in mirrored:
+                            hash_forget(ent.name)  # replaced content
+                        hash_record(ent.name, hasher)
+                        mirrored[ent.path_lower]={"name":ent.name, "rev":ent.rev}
+                        _index_note(ent.name)
+                        if TIERED:
+                            CACHE.add(ent.name, ent.size, stored=BLOBS.is_dropbox)
+                            if not BLOBS.is_dropbox:
+                                _BLOB_POOL.submit(_blob_push, ent.name)
+                        queue_renditions(ent.name)
+                        queue_meta(ent.name)
                         new_count+=1
-                    except Exception as e:
-                        log.warning(f"Download failed {name}: {e}")
+                    else:
+                        failed+=1
+        if TIERED and new_count:
+            _cache_evict()
+        log.info(f"Dropbox sync: {len(entries)} {'listed' if full else 'changed'}, {new_count} downloaded, "
+                 f"{removed} removed, {skipped} duplicates, {failed} failed in {time.time()-started:.1f}s")
+
+        # Failed downloads keep the old cursor so the next sync sees those changes again
+        if not failed:
+            state["cursor"]=cursor
+        _save_sync_state(state)
 
-        if new_count>0:
-            get_images(force=True)
-        return True, f"Downloaded {new_count} new files"
+        if new_count>0 or removed>0:
+            publish_event("images", added=new_count, removed=removed)
+        publish_event("sync", ok=True)
+        msg=f"Downloaded {new_count} new files"
+        if removed:
+            msg+=f", removed {removed}"
+        if failed:
+            msg+=f" ({failed} failed)"
+        return True, msg
+    except dropbox.exceptions.AuthError as e:
+        reset_dropbox_client()
+        return False, f"Sync auth error: {e}"
     except Exception as e:
         return False, f"Sync error: {e}"
 
+def request_sync(reason, rush=False, wait=None):
+    """Queue a Dropbox sync. Triggers arriving while one is queued share a single run,
+    which starts once triggers have been quiet for SYNC_DEBOUNCE_SECONDS (at once with
+    rush=True). With wait=<seconds>, block until a run that started after this call has
+    finished and return its (ok, message); None on timeout or when not waiting."""
+    global _SYNC_WORKER
+    with _SYNC_COND:
+        if _SYNC_WORKER is None or not _SYNC_WORKER.is_alive():
+            # started lazily so every forked gunicorn worker gets its own thread
+            _SYNC_WORKER=Thread(target=_sync_worker, name="dropbox-sync", daemon=True)
+            _SYNC_WORKER.start()
+        job=_SYNC_JOB
+        now=time.time()
+        if not job["first_request"]:
+            job["first_request"]=now
+        job["requested"]+=1
+        ticket=job["requested"]
+        job["last_request"]=now
+        job["reasons"].add(reason)
+        job["rush"]=job["rush"] or rush
+        if job["state"]=="idle":
+            job["state"]="queued"
+        _SYNC_COND.notify_all()
+        if wait is None:
+            return None
+        deadline=now+wait
+        while job["completed"]<ticket:
+            remaining=deadline-time.time()
+            if remaining<=0:
+                return None
+            _SYNC_COND.wait(remaining)
+        return job["last_ok"], job["last_message"]
+
+def _sync_worker():
+    job=_SYNC_JOB
+    while True:
+        with _SYNC_COND:
+            while job["requested"]<=job["completed"]:
+                _SYNC_COND.wait()
+            while not job["rush"]:
+                now=time.time()
+                due=min(job["last_request"]+SYNC_DEBOUNCE_SECONDS, job["first_request"]+SYNC_MAX_DELAY_SECONDS)
+                if now>=due:
+                    break
+                _SYNC_COND.wait(due-now)
+            ticket=job["requested"]
+            requested_at=job["last_request"]
+            reasons=sorted(job["reasons"])
+            job.update(state="running", rush=False, reasons=set(), first_request=0.0,
+                       last_started=time.time(), last_reasons=reasons)
+        try:
+            ok,msg,joined=run_sync_exclusive(requested_at, reasons)
+        except Exception as e:
+            ok,msg,joined=False,f"Sync error: {e}",False
+        log.info(f"Sync job ({', '.join(reasons)}){' joined another worker' if joined else ''}: {msg}")
+        with _SYNC_COND:
+            job.update(completed=ticket, last_finished=time.time(), last_ok=ok, last_message=msg, runs=job["runs"]+1)
+            job["state"]="queued" if job["requested"]>ticket else "idle"
+            _SYNC_COND.notify_all()
+
+def sync_job_status():
+    with _SYNC_COND:
+        job=_SYNC_JOB
+        return {"state":job["state"], "queued_triggers":job["requested"]-job["completed"],
+                "last_started":job["last_started"], "last_finished":job["last_finished"],
+                "last_ok":job["last_ok"], "last_message":job["last_message"],
+                "last_reasons":job["last_reasons"], "runs":job["runs"]}
+
+def _longpoll_loop():
+    """Block on files_list_folder_longpoll and sync as soon as Dropbox reports changes."""
+    while True:
+        try:
+            cursor=_load_sync_state().get("cursor")
+            dbx=get_dropbox_client() if cursor else None
+            if not dbx:
+                ok,msg=request_sync("longpoll", rush=True, wait=SYNC_MANUAL_WAIT_SECONDS) or (False, "timed out")  # establishes the cursor
+                if not ok:
+                    log.warning(f"Longpoll sync failed: {msg}")
+                    time.sleep(60)
+                continue
+            res=dbx.files_list_folder_longpoll(cursor, timeout=DROPBOX_LONGPOLL_TIMEOUT)
+            if res.changes:
+                # wait for the run so the next longpoll starts from the updated cursor
+                ok,msg=request_sync("longpoll", rush=True, wait=SYNC_MANUAL_WAIT_SECONDS) or (False, "timed out")
+                log.info(f"Longpoll sync: {msg}")
+            if res.backoff:
+                time.sleep(res.backoff)
+        except Exception as e:
+            log.warning(f"Longpoll error: {e}")
+            time.sleep(30)
+
+_BACKGROUND_STARTED = False
+_BACKGROUND_LOCK = Lock()
+
+@app.before_request
+def _start_background():
+    # Started on the first request rather than at import so it runs in each forked worker
+    global _BACKGROUND_STARTED
+    if _BACKGROUND_STARTED:
+        return
+    with _BACKGROUND_LOCK:
+        if _BACKGROUND_STARTED:
+            return
+        _BACKGROUND_STARTED=True
+        Thread(target=_hash_backfill, name="hash-backfill", daemon=True).start()
+        Thread(target=_meta_backfill, name="meta-backfill", daemon=True).start()
+        if TIERED:
+            Thread(target=_cache_backfill, name="cache-backfill", daemon=True).start()
+        if DROPBOX_LONGPOLL:
+            Thread(target=_longpoll_loop, name="dropbox-longpoll", daemon=True).start()
+        if PROFILE_SAMPLE_SECONDS > 0:
+            _PROFILE["started"]=time.time()
+            if _gevent_patched():
+                # A sampler greenlet would only run while the others wait, so never see
+                # them; sample from a native thread with unpatched sleep/get_ident instead.
+                native_ident=gevent_monkey.get_original('threading', 'get_ident')
+                gevent_monkey.get_original('_thread', 'start_new_thread')(
+                    _profile_loop, (gevent_monkey.get_original('time', 'sleep'), native_ident, {native_ident(): "gevent-hub"}))
+            else:
+                Thread(target=_profile_loop, name="profiler", daemon=True).start()
+
+@app.before_request
+def _metrics_start():
+    g.metrics_start=time.perf_counter()
+
+@app.after_request
+def _metrics_record(resp):
+    # time to the response object; a streamed body (/events) is not included
+    start=g.pop('metrics_start', None)
+    if start is not None:
+        route=request.url_rule.rule if request.url_rule else "unmatched"
+        metric_observe("http_request_duration_seconds", time.perf_counter()-start, route=route, method=request.method)
+        metric_inc("http_requests_total", route=route, method=request.method, status=resp.status_code)
+    _metrics_flush()
+    return resp
+
+@before_render_template.connect_via(app)
+def _template_start(sender, template, context, **extra):
+    g.setdefault('template_starts', {})[template.name]=time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _template_done(sender, template, context, **extra):
+    start=g.get('template_starts', {}).pop(template.name, None)
+    if start is not None:
+        metric_observe("template_render_seconds", time.perf_counter()-start, template=template.name)
+
+def _download_file(dbx, ent):
+    """Stream one Dropbox file into IMAGES through a temp file and an atomic
+    put, retrying transient errors with exponential backoff. Returns the
+    ContentHasher of the stored file, or None if it failed."""
+    for attempt in range(1, SYNC_RETRIES+1):
+        tmp=os.path.join(IMAGE_FOLDER, f".sync-{uuid.uuid4().hex}.part")  # .part is not an image extension: never indexed
+        try:
+            _,resp=dbx.files_download(ent.path_lower)
+            hasher=ContentHasher()
+            try:
+                with open(tmp,'wb') as f:
+                    for chunk in resp.iter_content(SYNC_CHUNK_BYTES):
+                        hasher.update(chunk)
+                        f.write(chunk)
+            finally:
+                resp.close()
+            now=time.time()
+            os.utime(tmp,(now,now))
+            IMAGES.put(ent.name, tmp, move=True)
+            return hasher
+        except Exception as e:
+            try:
+                if os.path.exists(tmp): os.remove(tmp)
+            except OSError: pass
+            retryable=not isinstance(e, dropbox.exceptions.ApiError)
+            if not retryable or attempt==SYNC_RETRIES:
+                log.warning(f"Download failed {ent.name} (attempt {attempt}): {e}")
+                return None
+            delay=SYNC_RETRY_BACKOFF*2**(attempt-1)
+            if isinstance(e, dropbox.exceptions.RateLimitError) and e.backoff:
+                delay=max(delay, e.backoff)
+            time.sleep(delay)
+    return None
+
 # Utility
-def get_unique_filename(filepath, original_size):
-    if not os.path.exists(filepath):
-        return filepath
-    if os.path.getsize(filepath) == original_size:
-        return None
-    directory=os.path.dirname(filepath)
-    name,ext=os.path.splitext(os.path.basename(filepath))
-    counter=1
+def get_unique_filename(filename):
+    """First free `name (n).ext` variant of filename. Names are checked against the
+    in-memory index; content duplicates are caught by the hash index beforehand."""
+    taken=_IMAGE_CACHE["names"]
+    name,ext=os.path.splitext(filename)
+    cand=filename
+    counter=0
     while counter<=100:
-        cand=os.path.join(directory,f"{name} ({counter}){ext}")
-        if not os.path.exists(cand):
+        if cand not in taken and not IMAGES.exists(cand):
             return cand
-        if os.path.getsize(cand)==original_size:
-            return None
         counter+=1
+        cand=f"{name} ({counter}){ext}"
     return None
 
+# Upload ingestion
+def _sniff_image(head):
+    """(kind, width, height) from the first bytes of a file; None if it is not an
+    image we accept. Width/height are None when the header doesn't reach them."""
+    if head.startswith(b'\xff\xd8\xff'):
+        i=2
+        while i+9 < len(head):
+            if head[i]!=0xFF:
+                return ('jpeg', None, None)
+            marker=head[i+1]
+            if marker in (0xD8, 0x01) or 0xD0<=marker<=0xD7:
+                i+=2
+                continue
+            seg_len=int.from_bytes(head[i+2:i+4], 'big')
+            if 0xC0<=marker<=0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h=int.from_bytes(head[i+5:i+7], 'big')
+                w=int.from_bytes(head[i+7:i+9], 'big')
+                return ('jpeg', w, h)
+            i+=2+seg_len
+        return ('jpeg', None, None)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and len(head)>=24:
+        return ('png', int.from_bytes(head[16:20], 'big'), int.from_bytes(head[20:24], 'big'))
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head)>=10:
+        return ('gif', int.from_bytes(head[6:8], 'little'), int.from_bytes(head[8:10], 'little'))
+    if head[:4]==b'RIFF' and head[8:12]==b'WEBP' and len(head)>=30:
+        chunk=head[12:16]
+        if chunk==b'VP8 ':
+            return ('webp', int.from_bytes(head[26:28], 'little') & 0x3FFF, int.from_bytes(head[28:30], 'little') & 0x3FFF)
+        if chunk==b'VP8L':
+            bits=int.from_bytes(head[21:25], 'little')
+            return ('webp', (bits & 0x3FFF)+1, ((bits>>14) & 0x3FFF)+1)
+        if chunk==b'VP8X':
+            return ('webp', int.from_bytes(head[24:27], 'little')+1, int.from_bytes(head[27:30], 'little')+1)
+        return ('webp', None, None)
+    return None
+
+def _decodes(path, kind):
+    """Whether Pillow opens `path` as `kind` and its data is complete. JPEGs are decoded
+    at reduced scale (a truncated body fails); other formats are checked with verify()."""
+    try:
+        with Image.open(path) as img:
+            if (img.format or '').lower()!=kind:
+                return False
+            if kind=='jpeg':
+                img.draft('RGB', (256, 256))
+                img.load()
+            else:
+                img.verify()
+        return True
+    except Exception:
+        return False
+
+class IngestStream:
+    """Multipart file sink: the body is written to a hidden .part file in IMAGE_FOLDER
+    while it is hashed and its header kept for sniffing, so storing an upload is a
+    single link to its name and no byte is re-read. Memory use is bounded by SNIFF_BYTES."""
+    def __init__(self, path=None):
+        self.path=path or os.path.join(IMAGE_FOLDER, f".upload-{uuid.uuid4().hex}.part")
+        self.file=open(self.path, 'w+b' if path is None else 'r+b')
+        self.hasher=ContentHasher()
+        self.head=bytearray()
+        self.done=False
+
+    @classmethod
+    def adopt(cls, path):
+        """Wrap a .part file that was assembled elsewhere (chunked uploads): one hashing pass."""
+        stream=cls(path)
+        for chunk in iter(lambda: stream.file.read(HASH_CHUNK_BYTES), b''):
+            if len(stream.head) < SNIFF_BYTES:
+                stream.head+=chunk[:SNIFF_BYTES-len(stream.head)]
+            stream.hasher.update(chunk)
+        stream.file.seek(0)
+        return stream
+
+    def write(self, data):
+        if self.hasher.size+len(data) > MAX_UPLOAD_BYTES:
+            raise RequestEntityTooLarge()
+        if len(self.head) < SNIFF_BYTES:
+            self.head+=data[:SNIFF_BYTES-len(self.head)]
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)  # read/seek/tell/... for FileStorage
+
+    def sniff(self):
+        return _sniff_image(bytes(self.head))
+
+    def commit(self, name):
+        """Store the upload as `name`; False if that name is already taken."""
+        self.file.close()
+        self.done=IMAGES.put_new(name, self.path, move=True)
+        return self.done
+
+    def discard(self):
+        if self.done:
+            return
+        self.done=True
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class IngestRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream=IngestStream()
+        self.__dict__.setdefault('_ingest_streams', []).append(stream)
+        return stream
+
+app.request_class = IngestRequest
+
+@app.teardown_request
+def _discard_ingest_streams(exc=None):
+    for stream in request.__dict__.get('_ingest_streams', ()):
+        stream.discard()  # anything not committed (rejected, duplicate, failed)
+
+@app.errorhandler(RequestEntityTooLarge)
+def _upload_too_large(e):
+    msg=f"File too large (max {MAX_UPLOAD_BYTES//(1024*1024)} MB)"
+    if request.path.startswith('/api/'):
+        return jsonify({"status":"error","message":msg}),413
+    flash(f"❌ {msg}")
+    return redirect(url_for('upload'))
+
+def ingest_upload(file):
+    with timed("upload_ingest_seconds"):
+        status, name, detail = _ingest_upload(file)
+    metric_inc("uploads_total", status=status)
+    return status, name, detail
+
+def _ingest_upload(file):
+    """Validate, dedupe and store one uploaded file.
+    Returns (status, filename, detail) with status stored/duplicate/rejected/error."""
+    if not allowed_file(file.filename):
+        return "rejected", file.filename, "file type not allowed"
+    stream=file.stream if isinstance(file.stream, IngestStream) else None
+    owned=stream is None
+    try:
+        if owned:
+            # not parsed through IngestRequest: copy it in (and clean up ourselves)
+            stream=IngestStream()
+            for chunk in iter(lambda: file.stream.read(HASH_CHUNK_BYTES), b''):
+                stream.write(chunk)
+        info=stream.sniff()
+        if info is None:
+            return "rejected", file.filename, "not a valid image"
+        kind, width, height = info
+        if os.path.splitext(file.filename)[1].lower() not in KIND_EXTENSIONS[kind]:
+            return "rejected", file.filename, f"extension doesn't match content ({kind})"
+        if width and height and width*height > MAX_UPLOAD_PIXELS:
+            return "rejected", file.filename, f"image too large ({width}x{height})"
+        if Image is not None:
+            stream.flush()
+            if not _VERIFY_POOL.submit(_decodes, stream.path, kind).result():
+                return "rejected", file.filename, "not a valid image"
+        with _INGEST_LOCK:
+            # dedupe + name pick + rename must not interleave (same photo twice in a batch)
+            dup=find_duplicate(stream.hasher)
+            if dup:
+                return "duplicate", dup, "already uploaded"
+            name=get_unique_filename(secure_filename(file.filename))
+            while name is not None and not stream.commit(name):
+                name=get_unique_filename(secure_filename(file.filename))  # another worker took it
+            if name is None:
+                return "error", file.filename, "no free filename"
+            hash_record(name, stream.hasher)
+            _index_note(name)
+            if TIERED:
+                CACHE.add(name, stream.hasher.size, stored=False)
+        if TIERED:
+            _BLOB_POOL.submit(_blob_push, name)
+        queue_renditions(name)
+        queue_meta(name)
+        return "stored", name, f"{kind} {width}x{height}" if width else kind
+    except RequestEntityTooLarge:
+        return "rejected", file.filename, "file too large"
+    except Exception as e:
+        log.warning(f"Upload error {file.filename}: {e}")
+        return "error", file.filename, str(e)
+    finally:
+        if owned and stream is not None:
+            stream.discard()
+
 # Routes
+def _landing_page():
+    """(etag, html) of the slideshow page. Only the first SSR_PAGE_SIZE photos are
+    rendered, plus a boot manifest the client pages the rest in from, so the cost is
+    the same for 100 or 100k photos; the HTML is re-rendered only when the index changes."""
+    imgs=get_images()
+    page=imgs[:SSR_PAGE_SIZE]
+    meta=image_meta(page)
+    key=f"{index_etag()}-m{len(meta)}"
+    cached=_SSR_CACHE
+    if cached["key"]==key:
+        return key, cached["html"]
+    first=[{"medium": i["url"].replace('/images/', '/images/medium/', 1),
+            "alt": re.sub(r'[-_]', ' ', os.path.splitext(i["filename"])[0]),
+            "color": (meta.get(i["filename"]) or {}).get("color")} for i in page]
+    boot={"images":[i["url"] for i in page], "meta":[meta.get(i["filename"]) for i in page],
+          "total":len(imgs), "cursor":_IMAGE_CACHE["gen"]}
+    html=render_template('index.html', first_page=first, boot=boot)
+    _SSR_CACHE.update(key=key, html=html)
+    return key, html
+
 @app.route('/')
 def main():
-    images=get_images()
-    main_image=images[0] if images else None
-    carousel_images=images[1:] if len(images)>1 else []
-    return render_template('index.html', main_image=main_image, carousel_images=carousel_images)
+    etag, html = _landing_page()
+    return conditional_response(etag, lambda: app.response_class(html, mimetype='text/html'))
 
 @app.route('/all')
 def all_photos():
@@ -224,12 +1903,65 @@ def all_photos():
 def sync_page():
     return render_template('sync.html')
 
+def _send_image(directory, filename, accel_path, mimetype=None, cacheable=True):
+    """Send a stored image with caching headers. Range and conditional requests are
+    handled by send_from_directory; with IMAGE_ACCEL_PREFIX (nginx) or USE_X_SENDFILE
+    the front proxy transfers the bytes instead of this worker."""
+    path=safe_join(directory, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+    if IMAGE_ACCEL_PREFIX:
+        resp=send_from_directory(directory, filename, mimetype=mimetype)  # headers (ETag, Last-Modified, type)
+        resp.direct_passthrough=False
+        resp.set_data(b'')
+        resp.headers['X-Accel-Redirect']=f"{IMAGE_ACCEL_PREFIX}/{accel_path}"
+    else:
+        try:
+            resp=send_from_directory(directory, filename, mimetype=mimetype, conditional=True)
+        except NotFound:
+            abort(404)
+    resp.headers['Accept-Ranges']='bytes'
+    return _cache_headers(resp, cacheable)
+
+def _is_current(filename):
+    """Whether ?v= names the indexed version of `filename`; only such URLs are immutable."""
+    v=request.args.get('v')
+    if not v:
+        return False
+    get_images()
+    item=_IMAGE_CACHE["names"].get(filename)
+    return item is not None and item["version"]==v
+
+def _cache_headers(resp, cacheable):
+    """`cacheable`: the URL is versioned with the current version (see _is_current)."""
+    resp.cache_control.no_cache=None  # send_file marks everything no-cache by default
+    if cacheable:
+        resp.cache_control.public=True
+        resp.cache_control.max_age=IMAGE_CACHE_SECONDS
+        resp.cache_control.immutable=True
+    else:
+        resp.cache_control.public=True
+        resp.cache_control.max_age=IMAGE_REVALIDATE_SECONDS
+    return resp
+
 @app.route('/images/<filename>')
-def serve_image(filename):
-    try:
-        return send_from_directory(IMAGE_FOLDER, filename)
-    except:
+def serve_image(filename, cacheable=True):
+    cacheable=cacheable and _is_current(filename)
+    if TIERED and ensure_local(filename):
+        CACHE.touch(filename)
+    return _send_image(IMAGE_FOLDER, filename, f"images/{quote(filename)}", cacheable=cacheable)
+
+@app.route('/images/<size>/<filename>')
+def serve_rendition(size, filename):
+    if size not in RENDITION_SIZES:
         abort(404)
+    path=get_rendition(size, filename)
+    if not path:
+        # the original stands in, but isn't pinned as this URL forever
+        return serve_image(filename, cacheable=False)
+    name=os.path.basename(path)
+    return _send_image(os.path.join(RENDITION_FOLDER, size), name, f"renditions/{size}/{quote(name)}",
+                       mimetype='image/webp', cacheable=_is_current(filename))
 
 @app.route('/<filename>')
 def serve_image_root(filename):
@@ -239,8 +1971,75 @@ def serve_image_root(filename):
 
 @app.route('/api/images')
 def api_images():
+    """Full list by default. ?since=<cursor> returns only newer images (full=false),
+    ?offset=&limit= pages through whichever list is returned, and ?meta=1 adds the
+    stored metadata of each image (null until extracted)."""
+    imgs=get_images()
+    since=request.args.get('since', type=float)  # float: pre-generation clients sent mtimes
+    offset=max(0, request.args.get('offset', 0, type=int))
+    limit=request.args.get('limit', type=int)
+    cursor=_IMAGE_CACHE["gen"]
+    sel, full = imgs, True
+    if since is not None:
+        delta=images_since(since)
+        if delta is not None:
+            sel, full = delta, False
+    total=len(sel)
+    end=total if limit is None else offset+max(0, limit)
+    page=sel[offset:end]
+    etag=index_etag()
+    meta=None
+    if request.args.get('meta','').lower() in ('1','true','yes'):
+        meta=image_meta(page)
+        etag=f"{etag}-m{len(meta)}"  # records fill in after the index changes
+
+    def build():
+        out={'status':'success','images':[i['url'] for i in page],'count':len(imgs),
+             'cursor':cursor,'full':full,'offset':offset,'total':total,'has_more':end<total}
+        if meta is not None:
+            out['meta']=[meta.get(i['filename']) for i in page]
+        return out
+
+    return conditional_json(etag, build)
+
+@app.route('/api/manifest')
+def api_manifest():
+    """Playback manifest: the `count` images from `start` in slideshow order, with
+    rendition URLs, dimensions and byte sizes for preloading. ?wrap=1 continues from
+    the first image past the end, as the slideshow loops. Also pages the /all grid.
+    ?f=<filename> (repeatable) asks for those images instead, in that order, for
+    clients whose own order has drifted from the server's (delta appends)."""
     imgs=get_images()
-    return jsonify({'status':'success','images':[i['url'] for i in imgs],'count':len(imgs)})
+    start=max(0, request.args.get('start', 0, type=int))
+    count=min(MANIFEST_MAX_COUNT, max(0, request.args.get('count', MANIFEST_DEFAULT_COUNT, type=int)))
+    wrap=request.args.get('wrap','').lower() in ('1','true','yes')
+    files=request.args.getlist('f')[:MANIFEST_MAX_COUNT]
+    total=len(imgs)
+    if files:
+        names=_IMAGE_CACHE["names"]
+        start, wrap = 0, True  # no paging
+        page=[names[f] for f in files if f in names]
+    elif wrap and total:
+        start%=total
+        page=[imgs[(start+k)%total] for k in range(min(count, total))]
+    else:
+        page=imgs[start:start+count]
+    meta=image_meta(page)
+    payload={'status':'success','start':start,'total':total,'cursor':_IMAGE_CACHE["gen"],
+             'has_more':not wrap and start+len(page)<total,
+             'items':[manifest_entry(i, meta.get(i["filename"])) for i in page]}
+    # byte sizes fill in as renditions are generated, so validate on the payload itself
+    etag=hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=12).hexdigest()
+    return conditional_json(etag, lambda: payload)
+
+@app.route('/events')
+def events():
+    """Server-Sent Events: `images` when photos are added, `sync` when a Dropbox sync ends."""
+    last_id=request.headers.get('Last-Event-ID', type=float)
+    resp=Response(stream_with_context(_event_stream(last_id)), mimetype='text/event-stream')
+    resp.headers['Cache-Control']='no-cache'
+    resp.headers['X-Accel-Buffering']='no'  # don't let a proxy buffer the stream
+    return resp
 
 @app.route('/media/<filename>')
 def serve_media(filename):
@@ -271,30 +2070,14 @@ def upload():
         uploaded_files=[]
 
         for file in files:
-            if not allowed_file(file.filename):
-                error_count+=1
-                continue
-            try:
-                safe=secure_filename(file.filename)
-                tmp=os.path.join(IMAGE_FOLDER,f"temp_{uuid.uuid4().hex}_{safe}")
-                file.save(tmp)
-                size=os.path.getsize(tmp)
-                dest=os.path.join(IMAGE_FOLDER,safe)
-                unique=get_unique_filename(dest,size)
-                if unique is None:
-                    os.remove(tmp)
-                    ignored_count+=1
-                    continue
-                if tmp!=unique:
-                    os.rename(tmp,unique)
-                uploaded_files.append(os.path.basename(unique))
+            status,name,detail=ingest_upload(file)
+            if status=="stored":
+                uploaded_files.append(name)
                 uploaded_count+=1
-            except Exception as e:
+            elif status=="duplicate":
+                ignored_count+=1
+            else:
                 error_count+=1
-                try:
-                    if os.path.exists(tmp): os.remove(tmp)
-                except: pass
-                log.warning(f"Upload error {file.filename}: {e}")
 
         if uploaded_count:
             flash(f"✅ Uploaded {uploaded_count} photo{'s' if uploaded_count!=1 else ''}")
@@ -306,38 +2089,150 @@ def upload():
             flash(f"❌ Failed {error_count} file{'s' if error_count!=1 else ''}")
 
         if uploaded_count:
-            get_images(force=True)
-            ok,msg=sync_dropbox_images(DROPBOX_FOLDER)
-            if ok: flash("🔄 Synced to Dropbox")
-            else: flash(f"⚠️ Dropbox sync failed: {msg}")
+            publish_event("images", added=uploaded_count)
+            request_sync("upload")
+            flash("🔄 Dropbox sync queued")
 
         return redirect(url_for('upload'))
 
-    images=get_images()
-    return render_template('upload.html', images=images)
+    return render_template('upload.html')
+
+@app.route('/api/upload', methods=['POST'])
+def api_upload():
+    """Batch upload: every file part of one multipart request (`files[]` or `file`),
+    finalized on a bounded pool. Returns a status per file and queues one sync."""
+    files=[f for key in ('files[]','file') for f in request.files.getlist(key) if f and f.filename]
+    if not files:
+        return jsonify({"status":"error","message":"No file selected"}),400
+    with ThreadPoolExecutor(max_workers=min(UPLOAD_CONCURRENCY, len(files)), thread_name_prefix="ingest") as pool:
+        outcomes=list(pool.map(ingest_upload, files))
+    results=[{"name":f.filename, "status":status, "filename":name, "detail":detail}
+             for f,(status,name,detail) in zip(files, outcomes)]
+    counts={k:sum(1 for r in results if r["status"]==k) for k in ("stored","duplicate","rejected","error")}
+    if counts["stored"]:
+        publish_event("images", added=counts["stored"])
+        request_sync("upload")
+    return jsonify({"status":"success","results":results,**counts})
+
+# --- Resumable chunked uploads ---
+# init -> PUT chunks at byte offsets (resend from GET's offset after a drop) -> finalize.
+# Bytes are assembled in a hidden .part file inside IMAGE_FOLDER, so finalizing is
+# the same validate/dedupe/rename as a normal upload.
+
+def _chunked_paths(upload_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id):
+        abort(404)
+    return (os.path.join(CHUNKED_FOLDER, upload_id+'.json'),
+            os.path.join(IMAGE_FOLDER, f".chunked-{upload_id}.part"))
+
+def _chunked_session(upload_id):
+    meta_path, part_path = _chunked_paths(upload_id)
+    try:
+        with open(meta_path,'r') as f:
+            meta=json.load(f)
+        meta["offset"]=os.path.getsize(part_path)
+    except (OSError, ValueError):
+        abort(404)
+    return meta, meta_path, part_path
+
+def _chunked_cleanup():
+    """Drop sessions that were abandoned for longer than CHUNKED_UPLOAD_TTL."""
+    cutoff=time.time()-CHUNKED_UPLOAD_TTL
+    with os.scandir(CHUNKED_FOLDER) as it:
+        for e in it:
+            if e.name.endswith('.json') and e.stat().st_mtime < cutoff:
+                meta_path, part_path = _chunked_paths(e.name[:-5])
+                for p in (meta_path, part_path):
+                    try: os.remove(p)
+                    except OSError: pass
+
+@app.route('/api/upload/chunked', methods=['POST'])
+def chunked_init():
+    payload=request.get_json(silent=True) or {}
+    filename=str(payload.get("filename") or "")
+    size=payload.get("size")
+    if not allowed_file(filename):
+        return jsonify({"status":"error","message":"File type not allowed"}),400
+    if not isinstance(size, int) or size<=0:
+        return jsonify({"status":"error","message":"Missing size"}),400
+    if size>MAX_UPLOAD_BYTES:
+        return jsonify({"status":"error","message":f"File too large (max {MAX_UPLOAD_BYTES//(1024*1024)} MB)"}),413
+    _chunked_cleanup()
+    upload_id=uuid.uuid4().hex
+    meta_path, part_path = _chunked_paths(upload_id)
+    open(part_path,'wb').close()
+    with open(meta_path,'w') as f:
+        json.dump({"filename":filename, "size":size, "created":time.time()}, f)
+    return jsonify({"status":"success","upload_id":upload_id,"offset":0,"size":size,"chunk_size":CHUNK_MAX_BYTES}),201
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['GET'])
+def chunked_status(upload_id):
+    meta,_,_=_chunked_session(upload_id)
+    return jsonify({"status":"success","upload_id":upload_id,"offset":meta["offset"],"size":meta["size"]})
+
+@app.route('/api/upload/chunked/<upload_id>', methods=['PUT'])
+def chunked_put(upload_id):
+    """Write the body at ?offset=. Re-sending bytes already received is harmless;
+    a gap is refused with 409 and the offset to resume from."""
+    meta, meta_path, part_path = _chunked_session(upload_id)
+    offset=request.args.get('offset', type=int)
+    length=request.content_length
+    if offset is None or offset<0 or offset>meta["offset"]:
+        return jsonify({"status":"error","message":"Resume from offset","offset":meta["offset"]}),409
+    if length is None or length>CHUNK_MAX_BYTES or offset+length>meta["size"]:
+        return jsonify({"status":"error","message":"Bad chunk length","offset":meta["offset"]}),400
+    with open(part_path,'r+b') as f:
+        f.seek(offset)
+        remaining=length
+        while remaining>0:
+            data=request.stream.read(min(remaining, HASH_CHUNK_BYTES))
+            if not data:
+                break  # client went away; what we got is kept for the resume
+            f.write(data)
+            remaining-=len(data)
+    os.utime(meta_path)  # keep the session alive
+    return jsonify({"status":"success","offset":os.path.getsize(part_path),"size":meta["size"]})
+
+@app.route('/api/upload/chunked/<upload_id>/finalize', methods=['POST'])
+def chunked_finalize(upload_id):
+    meta, meta_path, part_path = _chunked_session(upload_id)
+    if meta["offset"]!=meta["size"]:
+        return jsonify({"status":"error","message":"Upload incomplete","offset":meta["offset"]}),409
+    stream=IngestStream.adopt(part_path)
+    try:
+        status,name,detail=ingest_upload(FileStorage(stream=stream, filename=meta["filename"]))
+    finally:
+        stream.discard()  # no-op once committed
+    os.remove(meta_path)
+    if status=="stored":
+        publish_event("images", added=1)
+        request_sync("upload")
+    return jsonify({"status":"success","result":{"name":meta["filename"],"status":status,"filename":name,"detail":detail}})
 
 # --- Sync API used by sync.html ---
 
 def _dropbox_basic_status():
-    dbx=get_dropbox_client()
-    if not dbx:
-        return False, None
     try:
-        acc=dbx.users_get_current_account()
-        return True, {"name":acc.name.display_name, "email":acc.email}
+        acc=get_dropbox_account()
     except Exception as e:
         log.warning(f"Account info error: {e}")
         return False, None
+    if not acc:
+        return False, None
+    return True, {"name":acc.name.display_name, "email":acc.email}
+
+def _manual_cooldown(record):
+    """Seconds since the last successful manual sync (any worker), or None."""
+    last=record.get("manual_ok_at")
+    return None if last is None else time.time()-last
 
 @app.route('/sync-status')
 def sync_status():
-    global LAST_SYNC_TIME
     connected, user_info = _dropbox_basic_status()
     imgs=get_images()
-    now=time.time()
-    last_sync_seconds_ago = None
-    if LAST_SYNC_TIME:
-        last_sync_seconds_ago = int(now - LAST_SYNC_TIME)
+    record=load_sync_record()
+    last_ago=_manual_cooldown(record)
+    last_sync_seconds_ago = None if last_ago is None else int(last_ago)
     can_sync_now = True
     if last_sync_seconds_ago is not None and last_sync_seconds_ago < SYNC_COOLDOWN_SECONDS:
         can_sync_now = False
@@ -348,22 +2243,26 @@ def sync_status():
         "local_images_count":len(imgs),
         "last_sync_seconds_ago":last_sync_seconds_ago,
         "sync_cooldown_seconds":SYNC_COOLDOWN_SECONDS,
-        "can_sync_now":can_sync_now
+        "can_sync_now":can_sync_now,
+        "sync_job":sync_job_status(),
+        "last_sync":record,
+        "sync_running_elsewhere":sync_running_elsewhere()
     })
 
 @app.route('/sync-dropbox-manual', methods=['POST'])
 def sync_dropbox_manual():
-    global LAST_SYNC_TIME
     payload=request.get_json(silent=True) or {}
     force=bool(payload.get("force"))
-    now=time.time()
-    last_ago = None if LAST_SYNC_TIME is None else now - LAST_SYNC_TIME
-    if not force and LAST_SYNC_TIME and last_ago < SYNC_COOLDOWN_SECONDS:
+    last_ago=_manual_cooldown(load_sync_record())
+    if not force and last_ago is not None and last_ago < SYNC_COOLDOWN_SECONDS:
         remaining=int(SYNC_COOLDOWN_SECONDS - last_ago)
         return jsonify({"status":"cooldown","message":f"Cooldown active ({remaining}s remaining)"})
-    ok,msg=sync_dropbox_images(DROPBOX_FOLDER)
+    # A sync already running in another worker is joined by the job queue, not repeated
+    result=request_sync("manual", rush=True, wait=SYNC_MANUAL_WAIT_SECONDS)
+    if result is None:
+        return jsonify({"status":"queued","message":"Sync still running in the background","sync_job":sync_job_status()}),202
+    ok,msg=result
     if ok:
-        LAST_SYNC_TIME=time.time()
         imgs=get_images()
         return jsonify({"status":"success","message":msg,"images_count":len(imgs)})
     return jsonify({"status":"error","message":msg}),500
@@ -372,10 +2271,33 @@ def sync_dropbox_manual():
 def generate_dropbox_token_page():
     return "<h1>Provide Dropbox credentials via environment variables (refresh token flow).</h1>"
 
+# Metrics
+@app.route('/metrics')
+def metrics():
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Collapsed stacks ("thread;file:func;... count") from the sampling profiler of the
+    worker serving this request, most frequent first; ?limit=, ?reset=1 clears them."""
+    if PROFILE_SAMPLE_SECONDS <= 0:
+        return jsonify({"status":"error","message":"Profiler disabled (set PROFILE_SAMPLE_SECONDS)"}),404
+    limit=request.args.get('limit', 500, type=int)
+    with _PROFILE_LOCK:
+        stacks=sorted(_PROFILE["stacks"].items(), key=lambda kv: kv[1], reverse=True)[:limit]
+        samples=_PROFILE["samples"]
+        if request.args.get('reset'):
+            _PROFILE["stacks"], _PROFILE["samples"] = {}, 0
+    resp=Response(''.join(f"{k} {v}\n" for k, v in stacks), mimetype='text/plain')
+    resp.headers['X-Profile-Pid']=str(os.getpid())
+    resp.headers['X-Profile-Samples']=str(samples)
+    return resp
+
 # Health
 @app.route('/health')
 def health():
-    return jsonify({"status":"ok","count":len(get_images())})
+    imgs=get_images()
+    return conditional_json(index_etag(), lambda: {"status":"ok","count":len(imgs)})
 
 @app.route('/ping')
 def ping():
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Load test for the slideshow's hot endpoints.
+
+Synthesizes image folders of the requested sizes, serves app.py from a local
+threaded WSGI server and drives it with concurrent clients. Reports p50/p99
+latency, throughput and RSS per endpoint. Dropbox is replaced by a local
+stand-in, so syncs are measured without network access or credentials.
+
+    python benchmark.py --files 1000,10000,100000 --clients 32
+    python benchmark.py --files 10000 --save baseline.json
+    python benchmark.py --files 10000 --compare baseline.json   # exit 1 on regression
+
+Every folder size runs in its own process, so app.py's module-level config and
+caches start cold and RSS is per size.
+"""
+
+import argparse
+import http.client
+import io
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+SCENARIOS = ["api_images", "api_images_304", "api_delta", "manifest", "index", "image", "rendition", "upload", "sync"]
+DEFAULT_SCENARIOS = [s for s in SCENARIOS if s != "rendition"]  # rendition cold path needs Pillow + CPU
+BOUNDARY = "benchmarkboundary"
+
+# --- synthetic data -------------------------------------------------------
+
+def _template_image():
+    """A small JPEG (PNG without Pillow) used as the body of every synthetic photo."""
+    try:
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new("RGB", (64, 48), (180, 90, 40)).save(buf, "JPEG", quality=70)
+        return buf.getvalue(), ".jpg"
+    except ImportError:
+        return bytes.fromhex(
+            "89504e470d0a1a0a0000000d4948445200000001000000010802000000907753de"
+            "0000000c4944415408d763f8cfc000000301010018dd8db00000000049454e44ae426082"), ".png"
+
+def _unique(body, n):
+    # bytes after the end-of-image marker are ignored by decoders but change the hash
+    return body + b"bench-%d" % n
+
+def synthesize(folder, count, prefix="photo"):
+    body, ext = _template_image()
+    os.makedirs(folder, exist_ok=True)
+    base = time.time() - count
+    for i in range(count):
+        path = os.path.join(folder, f"{prefix}_{i:06d}{ext}")
+        with open(path, "wb") as f:
+            f.write(_unique(body, i) + prefix.encode())
+        os.utime(path, (base + i, base + i))
+    return body, ext
+
+# --- Dropbox stand-in -----------------------------------------------------
+
+class _Download:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+class LocalDropbox:
+    """Answers the Dropbox calls app.py makes from a local directory. The cursor is the
+    listing time; continuing returns files modified since then."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.calls = 0
+
+    def _meta(self, name):
+        import dropbox
+        from app import ContentHasher
+        with open(os.path.join(self.folder, name), "rb") as f:
+            data = f.read()
+        h = ContentHasher()
+        h.update(data)
+        st = os.stat(os.path.join(self.folder, name))
+        return dropbox.files.FileMetadata(
+            name=name, path_lower="/" + name.lower(), id="id:" + name, size=len(data),
+            rev="%09x" % int(st.st_mtime), content_hash=h.dropbox_hexdigest())
+
+    def _listing(self, since):
+        self.calls += 1
+        now = time.time()
+        entries = [self._meta(n) for n in sorted(os.listdir(self.folder))
+                   if os.path.getmtime(os.path.join(self.folder, n)) > since]
+        return SimpleNamespace(entries=entries, has_more=False, cursor=repr(now))
+
+    def files_list_folder(self, path, **kwargs):
+        return self._listing(0)
+
+    def files_list_folder_continue(self, cursor):
+        return self._listing(float(cursor))
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        time.sleep(min(timeout, 1))
+        return SimpleNamespace(changes=False, backoff=None)
+
+    def files_download(self, path):
+        self.calls += 1
+        name = path.lstrip("/")
+        meta = self._meta(next(n for n in os.listdir(self.folder) if n.lower() == name))
+        with open(os.path.join(self.folder, meta.name), "rb") as f:
+            return meta, _Download(f.read())
+
+    def users_get_current_account(self):
+        return SimpleNamespace(name=SimpleNamespace(display_name="Benchmark"), email="bench@localhost")
+
+# --- server and clients ---------------------------------------------------
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def _multipart(name, data):
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"files[]\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+def request(port, method, path, headers=None, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        data = resp.read()
+        return resp.status, resp.getheader("ETag"), data
+    finally:
+        conn.close()
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def drive(port, make_request, total, clients):
+    """Issue `total` requests from `clients` threads; latency stats in milliseconds."""
+    counter = itertools.count()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client():
+        while next(counter) < total:
+            method, path, headers, body, expect = make_request()
+            t = time.perf_counter()
+            try:
+                status, _, _ = request(port, method, path, headers, body)
+            except Exception as e:
+                status = repr(e)
+            elapsed = (time.perf_counter() - t) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if status not in expect:
+                    errors.append(status)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for f in [pool.submit(client) for _ in range(clients)]:
+            f.result()
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "first_error": str(errors[0]) if errors else None,
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(latencies[-1], 2),
+        "rps": round(len(latencies) / wall, 1),
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+# --- one folder size (child process) ---------------------------------------
+
+def run_size(args):
+    work = tempfile.mkdtemp(prefix="slideshow-bench-")
+    os.environ.update(IMAGE_FOLDER=os.path.join(work, "images"), STATE_FOLDER=os.path.join(work, "state"),
+                      RENDITION_FOLDER=os.path.join(work, "renditions"), DROPBOX_FOLDER="",
+                      MAX_UPLOAD_BYTES=str(40 * 1024 * 1024))
+    t = time.perf_counter()
+    body, ext = synthesize(os.environ["IMAGE_FOLDER"], args.files)
+    dbx_folder = os.path.join(work, "dropbox")
+    synthesize(dbx_folder, args.dropbox_files, prefix="dropbox")
+    result = {"files": args.files, "synth_s": round(time.perf_counter() - t, 2)}
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as slideshow
+    with slideshow._DROPBOX_LOCK:
+        stub = LocalDropbox(dbx_folder)
+        slideshow._DROPBOX.update(client=stub, account=stub.users_get_current_account(), account_at=time.time() + 3600)
+    slideshow.log.setLevel("WARNING")
+    result["rss_import_mb"] = round(rss_mb(), 1)
+
+    t = time.perf_counter()
+    slideshow.get_images(force=True)
+    result["index_build_s"] = round(time.perf_counter() - t, 3)
+
+    server = make_server("127.0.0.1", 0, slideshow.app, server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    request(port, "GET", "/health")  # starts the backfill threads
+    if not args.no_warm:
+        t = time.perf_counter()
+        for th in threading.enumerate():
+            if th.name in ("hash-backfill", "meta-backfill"):
+                th.join()
+        slideshow._META_POOL.submit(lambda: None).result()
+        result["warm_s"] = round(time.perf_counter() - t, 2)
+
+    status, etag, data = request(port, "GET", "/api/images")
+    listing = json.loads(data)
+    cursor = listing["cursor"]
+    urls = listing["images"]  # versioned, so served as immutable like in the slideshow
+    uploads = itertools.count(10_000_000)
+    pick = itertools.count()
+
+    def image_path(prefix=""):
+        url = urls[next(pick) % len(urls)] if urls else "/images/missing.jpg"
+        return url.replace("/images/", f"/images/{prefix}", 1)
+
+    makers = {
+        "api_images": lambda: ("GET", "/api/images", {}, None, (200,)),
+        "api_images_304": lambda: ("GET", "/api/images", {"If-None-Match": etag}, None, (304,)),
+        "api_delta": lambda: ("GET", f"/api/images?since={cursor}", {}, None, (200,)),
+        "manifest": lambda: ("GET", f"/api/manifest?start={next(pick) % max(1, args.files)}&count=24&wrap=1", {}, None, (200,)),
+        "index": lambda: ("GET", "/", {}, None, (200,)),
+        "image": lambda: ("GET", image_path(), {}, None, (200,)),
+        "rendition": lambda: ("GET", image_path("medium/"), {}, None, (200,)),
+        "upload": lambda: ("POST", "/api/upload", {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"},
+                           _multipart(f"upload{ext}", _unique(body, next(uploads))), (200,)),
+    }
+
+    for name in args.scenarios:
+        if name == "sync":
+            runs = {}
+            for label in ("sync_full", "sync_noop"):
+                t = time.perf_counter()
+                status, _, data = request(port, "POST", "/sync-dropbox-manual", {"Content-Type": "application/json"},
+                                          json.dumps({"force": True}).encode())
+                runs[label] = {"seconds": round(time.perf_counter() - t, 3), "status": status,
+                               "message": json.loads(data).get("message")}
+            runs["rss_mb"] = round(rss_mb(), 1)
+            result["sync"] = runs
+            continue
+        if name == "api_images_304":
+            _, etag, _ = request(port, "GET", "/api/images")
+        result[name] = drive(port, makers[name], args.requests, args.clients)
+
+    server.shutdown()
+    result["rss_peak_mb"] = round(_peak_rss_mb(), 1)
+    shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(result))
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+# --- driver ---------------------------------------------------------------
+
+def print_table(result):
+    print(f"\n📁 {result['files']} files  (index build {result['index_build_s']}s, "
+          f"import RSS {result['rss_import_mb']} MB, peak RSS {result['rss_peak_mb']} MB)")
+    print(f"   {'scenario':<16}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>10}{'errors':>8}{'RSS MB':>9}")
+    for name in SCENARIOS:
+        r = result.get(name)
+        if not r or name == "sync":
+            continue
+        print(f"   {name:<16}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}{r['rps']:>10}{r['errors']:>8}{r['rss_mb']:>9}")
+        if r["first_error"]:
+            print(f"   ⚠️  first error: {r['first_error']}")
+    if "sync" in result:
+        s = result["sync"]
+        for label in ("sync_full", "sync_noop"):
+            print(f"   {label:<16}{s[label]['seconds']:>10}s  {s[label]['status']}  {s[label]['message']}")
+
+def compare(results, baseline, tolerance):
+    """Regressions: p99 up or throughput down by more than `tolerance` vs the baseline."""
+    base = {r["files"]: r for r in baseline}
+    problems = []
+    for r in results:
+        old = base.get(r["files"])
+        if not old:
+            continue
+        for name in SCENARIOS:
+            new_s, old_s = r.get(name), old.get(name)
+            if not new_s or not old_s or name == "sync":
+                continue
+            if new_s["p99_ms"] > old_s["p99_ms"] * (1 + tolerance):
+                problems.append(f"{r['files']} files / {name}: p99 {old_s['p99_ms']} → {new_s['p99_ms']} ms")
+            if new_s["rps"] < old_s["rps"] * (1 - tolerance):
+                problems.append(f"{r['files']} files / {name}: {old_s['rps']} → {new_s['rps']} req/s")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", default="1000,10000", help="comma-separated folder sizes (default 1000,10000)")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients (default 16)")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario (default 500)")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS), help=f"any of {','.join(SCENARIOS)}")
+    parser.add_argument("--dropbox-files", type=int, default=200, help="files in the Dropbox stand-in (default 200)")
+    parser.add_argument("--no-warm", action="store_true", help="don't wait for hash/metadata backfill before measuring")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON from --save; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression ratio (default 0.25)")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if args.run_one is not None:
+        args.files = args.run_one
+        run_size(args)
+        return 0
+
+    results = []
+    for size in [int(x) for x in args.files.split(",") if x]:
+        print(f"⏱️  Running {size} files...", flush=True)
+        cmd = [sys.executable, os.path.abspath(__file__), "--run-one", str(size),
+               "--clients", str(args.clients), "--requests", str(args.requests),
+               "--scenarios", ",".join(args.scenarios), "--dropbox-files", str(args.dropbox_files)]
+        if args.no_warm:
+            cmd.append("--no-warm")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"❌ {size} files failed:\n{proc.stderr[-2000:]}")
+            return 1
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print_table(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Saved {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        if problems:
+            print("\n❌ Regressions:")
+            for p in problems:
+                print(f"   {p}")
+            return 1
+        print("\n✅ No regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# Gunicorn settings, read automatically by `gunicorn app:app` from this directory.
+# Everything can be overridden from the environment (Render dashboard or render.yaml).
+#
+# WEB_WORKER_CLASS=gevent (default when gevent is installed): each worker multiplexes
+#   WEB_CONNECTIONS clients on greenlets, so thousands of /events streams and slow
+#   phone uploads fit in a few processes. Image decoding still runs on real threads
+#   (see cpu_pool in app.py).
+# WEB_WORKER_CLASS=gthread: each worker serves WEB_THREADS requests at once. Slow
+#   uploads, /events streams and Dropbox calls each hold one thread, so with the
+#   defaults only WEB_CONCURRENCY x WEB_THREADS = 32 slideshow screens and uploads
+#   can be connected at a time; the next one waits for a free thread.
+import os
+
+try:
+    import gevent  # noqa: F401
+    _default_worker_class = "gevent"
+except ImportError:
+    _default_worker_class = "gthread"
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+worker_class = os.environ.get("WEB_WORKER_CLASS", _default_worker_class)
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("WEB_THREADS", 16))  # gthread only
+worker_connections = int(os.environ.get("WEB_CONNECTIONS", 1000))  # gevent only
+
+# A phone on party Wi-Fi can take minutes to send a 40 MB photo, and a manual
+# Dropbox sync waits up to 120 s; gthread/gevent workers heartbeat independently
+# of requests, so this only bounds a truly stuck worker.
+timeout = int(os.environ.get("WEB_TIMEOUT", 180))
+graceful_timeout = 30
+keepalive = 5  # seconds; slideshow screens poll and reuse the connection
+
+# Workers import the app themselves (no preload), so each one opens its own SQLite
+# connections, Dropbox session and background threads after the fork.
+preload_app = False
+
+accesslog = os.environ.get("WEB_ACCESS_LOG") or None  # "-" for stdout
+errorlog = "-"
+loglevel = os.environ.get("WEB_LOG_LEVEL", "info")
@@ -0,0 +1,472 @@
+"""
+Storage backends for originals, and the byte-bounded LRU cache used when a blob
+store is the source of truth (see STORAGE_CACHE_BYTES in app.py).
+
+Every backend is a flat namespace of files with the same interface: list, stat,
+open (a streaming binary reader), put (put_new never replaces), delete, and batch
+forms of stat/delete.
+"""
+
+import abc
+import io
+import os
+import shutil
+import time
+import uuid
+from collections import namedtuple
+from datetime import timezone
+from threading import Lock
+
+import dropbox
+from werkzeug.security import safe_join
+
+Stat = namedtuple("Stat", "name size mtime mtime_ns")
+
+class Storage(abc.ABC):
+    """A flat set of named files. open() raises FileNotFoundError for a missing name;
+    stat() returns None for one."""
+    is_dropbox = False
+    CHUNK_BYTES = 1024 * 1024
+
+    @abc.abstractmethod
+    def list(self):
+        """Iterate over every stored name."""
+
+    @abc.abstractmethod
+    def stat(self, name):
+        """Stat of `name`, or None if it doesn't exist."""
+
+    @abc.abstractmethod
+    def open(self, name):
+        """Binary reader over the file's bytes; close it (or use `with`) when done."""
+
+    @abc.abstractmethod
+    def put(self, name, src_path, move=False):
+        """Store the local file `src_path` as `name`, replacing it atomically.
+        With move=True the source is consumed (a rename where the backend allows)."""
+
+    def put_new(self, name, src_path, move=False):
+        """Like put, but claims `name` only if no file has it, atomically (also against
+        other processes); False if it was taken, with the source left in place."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, name):
+        """Remove `name`; False if it wasn't there."""
+
+    def path(self, name):
+        """Local filesystem path of `name` if this backend keeps files on local disk."""
+        return None
+
+    def version(self):
+        """Token that changes whenever the set of names does (ns timestamp), or None
+        if the backend can't tell cheaply; callers then rely on their own notes."""
+        return None
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    def stat_many(self, names):
+        """name -> Stat for those of `names` that exist."""
+        out = {}
+        for name in names:
+            st = self.stat(name)
+            if st is not None:
+                out[name] = st
+        return out
+
+    def delete_many(self, names):
+        """Remove several names; returns those that existed."""
+        return [name for name in names if self.delete(name)]
+
+    def read_chunks(self, name, chunk_bytes=None):
+        """Stream a file's bytes (FileNotFoundError is raised before the first chunk)."""
+        f = self.open(name)
+        def gen():
+            with f:
+                for chunk in iter(lambda: f.read(chunk_bytes or self.CHUNK_BYTES), b''):
+                    yield chunk
+        return gen()
+
+    def fetch(self, name, dest_path):
+        """Copy `name` to the local `dest_path` (atomically); False if it doesn't exist."""
+        try:
+            f = self.open(name)
+        except FileNotFoundError:
+            return False
+        with f:
+            _atomic_copy(f, dest_path)
+        return True
+
+def _atomic_copy(src, dest_path):
+    tmp = f"{dest_path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp, 'wb') as out:
+            shutil.copyfileobj(src, out, 1024 * 1024)
+        os.replace(tmp, dest_path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+class LocalFSStorage(Storage):
+    """Files in one local (or mounted) directory; the reference implementation."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        p = safe_join(self.root, name)
+        return p if p and os.path.dirname(p) == self.root.rstrip(os.sep) else None
+
+    def _path(self, name):
+        p = self.path(name)
+        if p is None:
+            raise FileNotFoundError(name)
+        return p
+
+    def list(self):
+        with os.scandir(self.root) as it:
+            for e in it:
+                if e.is_file():
+                    yield e.name
+
+    def stat(self, name):
+        try:
+            st = os.stat(self._path(name))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return Stat(name, st.st_size, st.st_mtime, st.st_mtime_ns)
+
+    def open(self, name):
+        return open(self._path(name), 'rb')
+
+    def put(self, name, src_path, move=False):
+        if move:
+            os.replace(src_path, self._path(name))
+            return
+        with open(src_path, 'rb') as f:
+            _atomic_copy(f, self._path(name))
+
+    def put_new(self, name, src_path, move=False):
+        dest = self._path(name)
+        tmp = src_path if move else f"{dest}.{uuid.uuid4().hex}.part"
+        try:
+            if not move:
+                shutil.copyfile(src_path, tmp)
+            os.link(tmp, dest)  # unlike a rename, fails if the name exists
+        except FileExistsError:
+            return False
+        finally:
+            if not move:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+        if move:
+            os.remove(src_path)
+        return True
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def version(self):
+        try:
+            return os.stat(self.root).st_mtime_ns
+        except OSError:
+            return None
+
+class MemoryStorage(Storage):
+    """Files held in a dict; for tests and benchmarks."""
+
+    def __init__(self):
+        self._files = {}  # name -> (bytes, mtime_ns)
+        self._lock = Lock()
+        self._version = time.time_ns()
+
+    def _changed(self):
+        self._version = max(time.time_ns(), self._version + 1)
+
+    def list(self):
+        with self._lock:
+            return iter(list(self._files))
+
+    def stat(self, name):
+        hit = self._files.get(name)
+        if hit is None:
+            return None
+        data, mtime_ns = hit
+        return Stat(name, len(data), mtime_ns / 1e9, mtime_ns)
+
+    def open(self, name):
+        hit = self._files.get(name)
+        if hit is None:
+            raise FileNotFoundError(name)
+        return io.BytesIO(hit[0])
+
+    def put(self, name, src_path, move=False):
+        with open(src_path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            self._files[name] = (data, time.time_ns())
+            self._changed()
+        if move:
+            os.remove(src_path)
+
+    def put_new(self, name, src_path, move=False):
+        with open(src_path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if name in self._files:
+                return False
+            self._files[name] = (data, time.time_ns())
+            self._changed()
+        if move:
+            os.remove(src_path)
+        return True
+
+    def delete(self, name):
+        with self._lock:
+            if self._files.pop(name, None) is None:
+                return False
+            self._changed()
+            return True
+
+    def version(self):
+        return self._version
+
+class _ResponseReader(io.RawIOBase):
+    """Raw reader over a streamed HTTP response (Dropbox downloads)."""
+
+    def __init__(self, resp):
+        self.resp = resp
+        resp.raw.decode_content = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.resp.raw.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.resp.close()
+        super().close()
+
+def _dropbox_stat(ent):
+    ts = ent.server_modified.replace(tzinfo=timezone.utc).timestamp()  # the SDK returns naive UTC
+    return Stat(ent.name, ent.size, ts, int(ts * 1e9))
+
+class DropboxStorage(Storage):
+    """Files in one Dropbox folder. `get_client` returns the shared client (or None)."""
+    is_dropbox = True
+    UPLOAD_CHUNK = 8 * 1024 * 1024  # files_upload takes up to 150 MB; larger go through a session
+    BATCH_POLL_SECONDS = 0.5
+
+    def __init__(self, get_client, folder, chunk_bytes=1024 * 1024):
+        self.get_client = get_client
+        self.folder = folder.strip().strip('/')
+        self.CHUNK_BYTES = chunk_bytes
+
+    def _path(self, name):
+        return f"/{self.folder}/{name}" if self.folder else f"/{name}"
+
+    def _client(self):
+        dbx = self.get_client()
+        if not dbx:
+            raise RuntimeError("No Dropbox credentials")
+        return dbx
+
+    def _entries(self):
+        dbx = self._client()
+        res = dbx.files_list_folder(f"/{self.folder}" if self.folder else "")
+        while True:
+            for ent in res.entries:
+                if isinstance(ent, dropbox.files.FileMetadata):
+                    yield ent
+            if not res.has_more:
+                return
+            res = dbx.files_list_folder_continue(res.cursor)
+
+    def list(self):
+        return (ent.name for ent in self._entries())
+
+    def stat(self, name):
+        try:
+            ent = self._client().files_get_metadata(self._path(name))
+        except dropbox.exceptions.ApiError as e:
+            if getattr(e.error, 'is_path', lambda: False)():
+                return None
+            raise
+        return _dropbox_stat(ent) if isinstance(ent, dropbox.files.FileMetadata) else None
+
+    def stat_many(self, names):
+        names = set(names)
+        if len(names) <= 1:
+            return super().stat_many(names)
+        return {ent.name: _dropbox_stat(ent) for ent in self._entries() if ent.name in names}  # one listing
+
+    def open(self, name):
+        try:
+            _, resp = self._client().files_download(self._path(name))
+        except dropbox.exceptions.ApiError as e:
+            if getattr(e.error, 'is_path', lambda: False)():
+                raise FileNotFoundError(name)
+            raise
+        return io.BufferedReader(_ResponseReader(resp), self.CHUNK_BYTES)
+
+    def put(self, name, src_path, move=False):
+        """Returns the FileMetadata Dropbox recorded (path_lower, rev, content_hash)."""
+        dbx = self._client()
+        size = os.path.getsize(src_path)
+        mode = dropbox.files.WriteMode.overwrite
+        with open(src_path, 'rb') as f:
+            if size <= self.UPLOAD_CHUNK:
+                ent = dbx.files_upload(f.read(), self._path(name), mode=mode)
+            else:
+                session = dbx.files_upload_session_start(f.read(self.UPLOAD_CHUNK))
+                cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+                while size - f.tell() > self.UPLOAD_CHUNK:
+                    dbx.files_upload_session_append_v2(f.read(self.UPLOAD_CHUNK), cursor)
+                    cursor.offset = f.tell()
+                ent = dbx.files_upload_session_finish(f.read(), cursor, dropbox.files.CommitInfo(path=self._path(name), mode=mode))
+        if move:
+            os.remove(src_path)
+        return ent
+
+    def delete(self, name):
+        try:
+            self._client().files_delete_v2(self._path(name))
+            return True
+        except dropbox.exceptions.ApiError as e:
+            if getattr(e.error, 'is_path_lookup', lambda: False)():
+                return False
+            raise
+
+    def delete_many(self, names):
+        """One batch job instead of a call per file."""
+        names = list(names)
+        if len(names) <= 1:
+            return super().delete_many(names)
+        dbx = self._client()
+        launch = dbx.files_delete_batch([dropbox.files.DeleteArg(self._path(n)) for n in names])
+        if launch.is_complete():
+            result = launch.get_complete()
+        else:
+            job = launch.get_async_job_id()
+            while True:
+                status = dbx.files_delete_batch_check(job)
+                if status.is_complete():
+                    result = status.get_complete()
+                    break
+                if status.is_failed():
+                    raise RuntimeError(f"Dropbox batch delete failed: {status.get_failed()}")
+                time.sleep(self.BATCH_POLL_SECONDS)
+        return [n for n, entry in zip(names, result.entries) if entry.is_success()]
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_files (filename TEXT PRIMARY KEY, size INTEGER, atime REAL, stored INTEGER);
+CREATE INDEX IF NOT EXISTS cache_files_atime ON cache_files(stored, atime);
+"""
+
+class LRUCache:
+    """Originals held in the `store` (the local image folder), bounded by `max_bytes`
+    and evicted least recently used first. Bookkeeping is a table in the shared SQLite
+    index (`db()` returns this thread's connection), so every worker sees the same
+    sizes and access times. Files not yet in the blob store (stored=0, or 2 while a push
+    is in flight) are never evicted."""
+    TOUCH_INTERVAL = 60  # seconds between atime writes for one file, per process
+    PUSH_CLAIM_SECONDS = 3600  # an older push claim belongs to a worker that died
+    LOW_WATER = 0.9  # evict down to this fraction so every add doesn't evict again
+
+    def __init__(self, store, max_bytes, db):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.db = db
+        self._touched = {}
+        self._lock = Lock()
+
+    def _conn(self):
+        return self.db()  # schema: CACHE_SCHEMA, created with the rest of the index
+
+    def add(self, name, size, stored):
+        self._conn().execute("INSERT OR REPLACE INTO cache_files (filename, size, atime, stored) VALUES (?,?,?,?)",
+                             (name, size, time.time(), int(stored)))
+
+    def claim_push(self, name):
+        """Reserve an unstored file for one push across all workers. False if it is
+        stored already or another push is in flight (the claim's time is its atime)."""
+        now = time.time()
+        cur = self._conn().execute(
+            "UPDATE cache_files SET stored=2, atime=? WHERE filename=? AND (stored=0 OR (stored=2 AND atime<?))",
+            (now, name, now - self.PUSH_CLAIM_SECONDS))
+        return cur.rowcount == 1
+
+    def release_push(self, name):
+        """Give up a claim after a failed push, so the file can be pushed again."""
+        self._conn().execute("UPDATE cache_files SET stored=0 WHERE filename=? AND stored=2", (name,))
+
+    def mark_stored(self, name):
+        self._conn().execute("UPDATE cache_files SET stored=1 WHERE filename=?", (name,))
+
+    def touch(self, name):
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(name, 0) < self.TOUCH_INTERVAL:
+                return
+            self._touched[name] = now
+        self._conn().execute("UPDATE cache_files SET atime=? WHERE filename=? AND stored!=2", (now, name))
+
+    def forget(self, name):
+        self._conn().execute("DELETE FROM cache_files WHERE filename=?", (name,))
+
+    def known(self):
+        return {r[0] for r in self._conn().execute("SELECT filename FROM cache_files")}
+
+    def unstored(self):
+        """Files still to push: never pushed, failed, or claimed by a worker that died."""
+        return [r[0] for r in self._conn().execute("SELECT filename FROM cache_files WHERE stored=0 OR (stored=2 AND atime<?)",
+                                                   (time.time() - self.PUSH_CLAIM_SECONDS,))]
+
+    def used_bytes(self):
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM cache_files").fetchone()[0]
+
+    def evict(self, keep=()):
+        """Remove least recently used stored originals until under the low-water mark,
+        never those in `keep` (e.g. one just fetched for a waiting request).
+        Returns the evicted names."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_files").fetchone()[0]
+            if used <= self.max_bytes:
+                conn.execute("COMMIT")
+                return []
+            target = used - int(self.max_bytes * self.LOW_WATER)
+            victims, freed = [], 0
+            for name, size in conn.execute("SELECT filename, size FROM cache_files WHERE stored=1 ORDER BY atime"):
+                if freed >= target:
+                    break
+                if name in keep:
+                    continue
+                victims.append(name)
+                freed += size
+            conn.executemany("DELETE FROM cache_files WHERE filename=?", [(n,) for n in victims])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.store.delete_many(victims)  # open readers keep their handle
+        with self._lock:
+            for name in victims:
+                self._touched.pop(name, None)
+        return victims
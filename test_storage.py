@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Tests for storage.py: the Storage contract every backend keeps, and the LRU cache
+of originals used with tiered storage. Run with `python -m pytest -q test_storage.py`.
+"""
+
+import sqlite3
+
+import pytest
+
+from storage import CACHE_SCHEMA, LocalFSStorage, LRUCache, MemoryStorage, Storage
+
+
+@pytest.fixture(params=["local", "memory"])
+def store(request, tmp_path):
+    if request.param == "local":
+        return LocalFSStorage(str(tmp_path / "store"))
+    return MemoryStorage()
+
+
+def put_bytes(store, tmp_path, name, data, move=False):
+    src = tmp_path / f"src-{name}"
+    src.write_bytes(data)
+    store.put(name, str(src), move=move)
+    return src
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_put_stat_open(store, tmp_path):
+    src = put_bytes(store, tmp_path, "a.jpg", b"hello")
+    assert src.exists()
+    st = store.stat("a.jpg")
+    assert (st.name, st.size) == ("a.jpg", 5)
+    assert st.mtime_ns > 0
+    with store.open("a.jpg") as f:
+        assert f.read() == b"hello"
+    assert store.exists("a.jpg")
+    assert list(store.list()) == ["a.jpg"]
+
+
+def test_put_replaces_and_moves(store, tmp_path):
+    put_bytes(store, tmp_path, "a.jpg", b"old")
+    src = put_bytes(store, tmp_path, "a.jpg", b"newer", move=True)
+    assert not src.exists()
+    assert store.stat("a.jpg").size == 5
+    assert b"".join(store.read_chunks("a.jpg", 2)) == b"newer"
+
+
+def test_put_new_never_replaces(store, tmp_path):
+    put_bytes(store, tmp_path, "a.jpg", b"first")
+    src = tmp_path / "src-b"
+    src.write_bytes(b"second")
+    assert store.put_new("a.jpg", str(src), move=True) is False
+    assert src.exists() and b"".join(store.read_chunks("a.jpg")) == b"first"
+    assert store.put_new("b.jpg", str(src), move=True) is True
+    assert not src.exists() and store.stat("b.jpg").size == 6
+    assert [p.name for p in tmp_path.rglob("*.part")] == []
+
+
+def test_missing_names(store, tmp_path):
+    assert store.stat("nope.jpg") is None
+    assert not store.exists("nope.jpg")
+    with pytest.raises(FileNotFoundError):
+        store.open("nope.jpg")
+    with pytest.raises(FileNotFoundError):
+        store.read_chunks("nope.jpg")
+    assert store.delete("nope.jpg") is False
+    assert store.fetch("nope.jpg", str(tmp_path / "out")) is False
+
+
+def test_batches(store, tmp_path):
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        put_bytes(store, tmp_path, name, name.encode())
+    stats = store.stat_many(["a.jpg", "c.jpg", "nope.jpg"])
+    assert sorted(stats) == ["a.jpg", "c.jpg"]
+    assert sorted(store.delete_many(["a.jpg", "nope.jpg", "b.jpg"])) == ["a.jpg", "b.jpg"]
+    assert list(store.list()) == ["c.jpg"]
+
+
+def test_fetch_copies(store, tmp_path):
+    put_bytes(store, tmp_path, "a.jpg", b"x" * 3000)
+    dest = tmp_path / "fetched.jpg"
+    assert store.fetch("a.jpg", str(dest)) is True
+    assert dest.read_bytes() == b"x" * 3000
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".part")] == []
+
+
+def test_version_moves_on_change(tmp_path):
+    # LocalFSStorage's version is the directory mtime, which may not tick between
+    # two quick writes; MemoryStorage's always does.
+    assert isinstance(LocalFSStorage(str(tmp_path)).version(), int)
+    store = MemoryStorage()
+    before = store.version()
+    put_bytes(store, tmp_path, "a.jpg", b"1")
+    after_put = store.version()
+    store.delete("a.jpg")
+    assert before < after_put < store.version()
+
+
+def test_local_rejects_paths_outside_root(tmp_path):
+    store = LocalFSStorage(str(tmp_path / "store"))
+    (tmp_path / "secret.txt").write_text("x")
+    assert store.path("../secret.txt") is None
+    assert store.stat("../secret.txt") is None
+    with pytest.raises(FileNotFoundError):
+        store.open("../secret.txt")
+
+
+@pytest.fixture
+def cache(store):
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.executescript(CACHE_SCHEMA)
+    return LRUCache(store, 1000, lambda: conn)
+
+
+def fill(cache, tmp_path, sizes):
+    for i, size in enumerate(sizes):
+        name = f"f{i}.jpg"
+        put_bytes(cache.store, tmp_path, name, b"x" * size)
+        cache.add(name, size, stored=True)
+        cache._conn().execute("UPDATE cache_files SET atime=? WHERE filename=?", (i, name))  # f0 is oldest
+
+
+def test_evict_under_limit_keeps_everything(cache, tmp_path):
+    fill(cache, tmp_path, [300, 300, 300])
+    assert cache.evict() == []
+    assert cache.used_bytes() == 900
+
+
+def test_evict_lru_to_low_water(cache, tmp_path):
+    fill(cache, tmp_path, [300, 300, 300, 300])
+    cache.touch("f0.jpg")  # now most recently used
+    assert cache.evict() == ["f1.jpg"]  # 1200 -> 900, down to 1000 * LOW_WATER
+    assert not cache.store.exists("f1.jpg") and cache.store.exists("f0.jpg")
+    assert cache.used_bytes() == 900
+    assert cache.known() == {"f0.jpg", "f2.jpg", "f3.jpg"}
+
+
+def test_evict_skips_unstored(cache, tmp_path):
+    fill(cache, tmp_path, [600, 600])
+    cache.add("f0.jpg", 600, stored=False)
+    assert cache.evict() == ["f1.jpg"]
+    assert cache.store.exists("f0.jpg")
+
+
+def test_evict_spares_kept_names(cache, tmp_path):
+    fill(cache, tmp_path, [300, 300, 1200])  # f2, the newest, is alone over the limit
+    assert cache.evict(keep={"f2.jpg"}) == ["f0.jpg", "f1.jpg"]
+    assert cache.store.exists("f2.jpg")
+
+
+def test_push_claims(cache, tmp_path):
+    cache.add("new.jpg", 10, stored=False)
+    assert cache.claim_push("new.jpg") is True
+    assert cache.claim_push("new.jpg") is False  # in flight elsewhere
+    assert cache.unstored() == []
+    cache.release_push("new.jpg")
+    assert cache.unstored() == ["new.jpg"]
+    assert cache.claim_push("new.jpg") is True
+    cache.mark_stored("new.jpg")
+    assert cache.claim_push("new.jpg") is False
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Tests for upload handling in app.py: content hashing, image sniffing and the
+resumable chunked-upload protocol. The app runs against throwaway folders.
+Run with `python -m pytest -q test_uploads.py`.
+"""
+
+import atexit
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="slideshow-test-")
+atexit.register(shutil.rmtree, _TMP, True)
+for _var in ("IMAGE_FOLDER", "RENDITION_FOLDER", "STATE_FOLDER"):
+    os.environ[_var] = os.path.join(_TMP, _var.split("_")[0].lower())
+os.environ.pop("STORAGE_CACHE_BYTES", None)
+
+import app  # noqa: E402  (reads the folders above at import)
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def image_bytes(fmt, size=(64, 48), color=(200, 40, 40)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, fmt)
+    return buf.getvalue()
+
+
+def dropbox_reference(data):
+    block = app.DROPBOX_HASH_BLOCK
+    digests = b"".join(hashlib.sha256(data[i:i + block]).digest() for i in range(0, len(data), block))
+    return hashlib.sha256(digests).hexdigest()
+
+
+def test_dropbox_hexdigest_empty():
+    assert app.ContentHasher().dropbox_hexdigest() == hashlib.sha256(b"").hexdigest()
+
+
+@pytest.mark.parametrize("size", [1, app.DROPBOX_HASH_BLOCK, 2 * app.DROPBOX_HASH_BLOCK + 5])
+def test_dropbox_hexdigest_blocks(size):
+    data = os.urandom(size)
+    h = app.ContentHasher()
+    for i in range(0, size, 1_000_003):  # chunks that straddle block boundaries
+        h.update(data[i:i + 1_000_003])
+    assert h.size == size
+    assert h.dropbox_hexdigest() == dropbox_reference(data)
+    assert h.hexdigest() == hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+@pytest.mark.parametrize("fmt, kind", [("JPEG", "jpeg"), ("PNG", "png"), ("GIF", "gif"), ("WEBP", "webp")])
+def test_sniff_image(fmt, kind):
+    assert app._sniff_image(image_bytes(fmt)[:app.SNIFF_BYTES]) == (kind, 64, 48)
+
+
+def test_sniff_image_rejects_and_truncates():
+    assert app._sniff_image(b"<html>not an image</html>") is None
+    assert app._sniff_image(b"") is None
+    assert app._sniff_image(image_bytes("JPEG")[:4]) == ("jpeg", None, None)
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def start_upload(client, filename, size):
+    r = client.post("/api/upload/chunked", json={"filename": filename, "size": size})
+    assert r.status_code == 201
+    return r.get_json()["upload_id"]
+
+
+def put_chunk(client, upload_id, offset, data):
+    return client.put(f"/api/upload/chunked/{upload_id}?offset={offset}", data=data)
+
+
+def test_chunked_upload_resumes_and_stores(client):
+    data = image_bytes("PNG", size=(300, 200), color=(10, 120, 30))
+    half = len(data) // 2
+    upload_id = start_upload(client, "party.png", len(data))
+
+    assert put_chunk(client, upload_id, 0, data[:half]).get_json()["offset"] == half
+    gap = put_chunk(client, upload_id, half + 10, data[half + 10:])
+    assert gap.status_code == 409 and gap.get_json()["offset"] == half
+    early = client.post(f"/api/upload/chunked/{upload_id}/finalize")
+    assert early.status_code == 409
+
+    # a dropped connection: ask where to resume, re-send an overlapping chunk
+    assert client.get(f"/api/upload/chunked/{upload_id}").get_json()["offset"] == half
+    assert put_chunk(client, upload_id, half - 5, data[half - 5:]).get_json()["offset"] == len(data)
+
+    result = client.post(f"/api/upload/chunked/{upload_id}/finalize").get_json()["result"]
+    assert result["status"] == "stored"
+    with open(os.path.join(app.IMAGE_FOLDER, result["filename"]), "rb") as f:
+        assert f.read() == data
+    assert client.get(f"/api/upload/chunked/{upload_id}").status_code == 404
+
+    again = start_upload(client, "copy.png", len(data))
+    put_chunk(client, again, 0, data)
+    assert client.post(f"/api/upload/chunked/{again}/finalize").get_json()["result"]["status"] == "duplicate"
+
+
+def test_chunked_upload_refuses_bad_requests(client):
+    assert client.post("/api/upload/chunked", json={"filename": "notes.txt", "size": 10}).status_code == 400
+    assert client.post("/api/upload/chunked", json={"filename": "a.jpg"}).status_code == 400
+    upload_id = start_upload(client, "a.jpg", 10)
+    assert put_chunk(client, upload_id, 0, b"x" * 11).status_code == 400
+    assert client.get("/api/upload/chunked/not-an-id").status_code == 404
+
+
+def test_chunked_upload_rejects_non_images(client):
+    data = b"GIF89a" + b"\x00" * 2  # right magic, but truncated before the dimensions
+    upload_id = start_upload(client, "fake.gif", len(data))
+    put_chunk(client, upload_id, 0, data)
+    result = client.post(f"/api/upload/chunked/{upload_id}/finalize").get_json()["result"]
+    assert result["status"] != "stored"
+    assert not os.path.exists(os.path.join(app.IMAGE_FOLDER, "fake.gif"))